@@ -30,38 +30,107 @@ GObject.threads_init()
 GObject.set_prgname(PACKAGE)
 GtkClutter.init([])
 
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GLib
 from gi.repository import GdkPixbuf
 from gi.repository import Champlain
 from os.path import join, basename, abspath
 from gettext import gettext as _
-from time import clock
+from re import compile as re_compile
+from time import clock, time
 from sys import argv
 
 # "If I have seen a little further it is by standing on the shoulders of Giants."
 #                                    --- Isaac Newton
 
-from photos import Photograph
-from xmlfiles import GPXFile, KMLFile
-from common import polygons, points, photos
-from common import auto_timestamp_comparison
-from common import metadata, selected, modified
+from photos import Photograph, IMAGE_MAGIC, IMAGE_EXTENSIONS
+from photos import fetch_all, save_all
+from xmlfiles import GPXFile, KMLFile, NMEAFile, FITFile, open_stream
+from common import polygons, points, photos, trackfiles
+from common import auto_position, auto_timestamp_comparison, estimate_offset
+from common import metadata, selected, modified, track_time
 from common import Struct, get_obj, gst, map_view
+from common import PATH, SUMMARY, THUMB, TIMESTAMP
 from common import gpx_sensitivity, clear_all_gpx
+from camera import CameraView
 
 from drag import DragController
 from actor import ActorController
-from label import LabelController
+from label import LabelController, known_change, refresh
 from search import SearchController
+from thumbview import ThumbnailController
 from navigation import NavigationController
 from preferences import PreferencesController
 
-# Handy names for GtkListStore column numbers.
-PATH, SUMMARY, THUMB, TIMESTAMP = range(4)
+# Track file classes by extension, for files that can't be sniffed.
+TRACK_FORMATS = {
+    'fit':  FITFile,
+    'gpx':  GPXFile,
+    'kml':  KMLFile,
+    'kmz':  KMLFile,
+    'nma':  NMEAFile,
+    'nmea': NMEAFile,
+}
+
+# Only this much of each file is read in order to determine what it is.
+SNIFF_SIZE = 1024
+
+# Seconds between redraws of the interface while loading many photos.
+REDRAW_INTERVAL = 0.1
+
+# Milliseconds to collect clock offset changes for before moving photos.
+OFFSET_DELAY = 50
+
+# Loading at least this many photos detaches the liststore from its view.
+BULK_MINIMUM = 100
+
+# GTK_TREE_SORTABLE_UNSORTED_SORT_COLUMN_ID
+UNSORTED = -2
+
+nmea_sentence = re_compile(r'(^|\n)\$[A-Z]{5},').search
+
+def sniff(filename):
+    """Determine what kind of file this is, based mostly on it's content.
+    
+    Returns either Photograph or the appropriate TrackFile subclass, or None
+    if it's something that we don't know how to load. Only the first few
+    bytes of the file are read, after decompressing it if necessary.
+    """
+    try:
+        with open(filename, 'rb') as raw:
+            header = raw.read(SNIFF_SIZE)
+        if header.startswith(IMAGE_MAGIC):
+            return Photograph
+        with open_stream(filename) as stream:
+            header = stream.read(SNIFF_SIZE)
+    except IOError:
+        return None
+    
+    text = header.lower()
+    if header[8:12] == '.FIT':  return FITFile
+    if '<gpx' in text:          return GPXFile
+    if '<kml' in text:          return KMLFile
+    if nmea_sentence(header):   return NMEAFile
+    
+    for extension in reversed(basename(filename).lower().split('.')[1:]):
+        if extension in TRACK_FORMATS:
+            return TRACK_FORMATS[extension]
+        if extension in IMAGE_EXTENSIONS:
+            return Photograph
+
+def show_thumbnail(column, cell, model, treeiter, data=None):
+    """Render the thumbnail, or a placeholder if it isn't loaded right now."""
+    thumb = model.get_value(treeiter, THUMB)
+    if thumb is None:
+        cell.set_property('stock-id', Gtk.STOCK_MISSING_IMAGE)
+    else:
+        cell.set_property('pixbuf', thumb)
 
 def toggle_selected_photos(button, sel):
     """Toggle the selection of photos."""
-    (sel.select_all if button.get_active() else sel.unselect_all)()
+    if button.get_active():
+        known_change(dict.fromkeys(photos.values(), True), sel.select_all)
+    else:
+        known_change(dict.fromkeys(selected, False), sel.unselect_all)
 
 
 class GottenGeography():
@@ -77,23 +146,60 @@ class GottenGeography():
 ################################################################################
     
     def open_files(self, files):
-        """Attempt to load all of the specified files."""
+        """Attempt to load all of the specified files.
+        
+        Files are sorted out by their content before anything is loaded, so
+        that all of the GPS tracks can be loaded ahead of the photos, which
+        then only need to be placed onto the map once. The photo metadata is
+        read by a pool of worker processes, while this process creates the
+        rows and labels for them, redrawing the interface only occasionally.
+        Many photos are added to the liststore while it is detached from the
+        view and unsorted, so that it's only sorted and drawn once.
+        """
         self.progressbar.show()
-        invalid, total = [], len(files)
-        for i, name in enumerate(files, 1):
+        invalid, tracks, images = [], [], []
+        for name in files:
+            kind = sniff(name)
+            if kind is None:
+                invalid.append(basename(name))
+            elif kind is Photograph:
+                images.append(name)
+            else:
+                tracks.append((name, kind))
+        
+        total = len(tracks) + len(images)
+        for i, (name, kind) in enumerate(tracks, 1):
             self.redraw_interface(i / total, basename(name))
             try:
-                try:            self.load_img_from_file(name)
-                except IOError: self.load_gpx_from_file(name)
+                self.load_gpx_from_file(name, kind)
             except IOError:
                 invalid.append(basename(name))
+        bulk = len(images) >= BULK_MINIMUM
+        if bulk:
+            reselect = selected.copy()
+            self.detach_liststore()
+        redraw = 0
+        try:
+            fetched = fetch_all(images, gst.get_boolean('xmp-sidecars'))
+            for i, (name, data) in enumerate(fetched, len(tracks) + 1):
+                if time() > redraw:
+                    self.redraw_interface(i / total, basename(name))
+                    redraw = time() + REDRAW_INTERVAL
+                try:
+                    self.load_img_from_file(name, data)
+                except IOError:
+                    invalid.append(basename(name))
+        finally:
+            if bulk:
+                self.attach_liststore(reselect)
+        
         if len(invalid) > 0:
             self.status_message(_('Could not open: ') + ', '.join(invalid))
         self.progressbar.hide()
-        self.labels.selection.emit('changed')
+        refresh(self.labels.selection)
         map_view.emit('animation-completed')
     
-    def load_img_from_file(self, uri):
+    def load_img_from_file(self, uri, data=None):
         """Create or update a row in the ListStore.
         
         Checks if the file has already been loaded, and if not, creates a new
@@ -101,40 +207,86 @@ class GottenGeography():
         photo metadata as read from disk. Effectively, this is used both for
         loading new photos, and reverting old photos, discarding any changes.
         
-        Raises IOError if filename refers to a file that is not a photograph.
+        data is the photo's metadata, if it has already been read. Raises
+        IOError if filename refers to a file that is not a photograph.
         """
         photo = photos.get(uri) or Photograph(uri, self.modify_summary)
-        photo.read()
+        photo.read(data, gst.get_boolean('xmp-sidecars'))
+        row = [uri, photo.long_summary(), photo.thumb, photo.timestamp]
         if uri not in photos:
-            photo.iter  = self.liststore.append()
+            photo.iter  = self.liststore.append(row)
             photo.label = self.labels.add(uri)
             photos[uri] = photo
+        else:
+            self.liststore.set_row(photo.iter, row)
         photo.position_label()
         modified.discard(photo)
-        self.liststore.set_row(photo.iter,
-            [uri, photo.long_summary(), photo.thumb, photo.timestamp])
         auto_timestamp_comparison(photo)
+        self.show_camera(photo.camera)
+    
+    def show_camera(self, camera):
+        """Offer the settings of each camera that photos were loaded from."""
+        if camera is not None and camera.id not in self.camera_views:
+            view = self.camera_views[camera.id] = CameraView(camera)
+            get_obj('cameras_view').pack_start(view, False, False, 0)
+    
+    def detach_liststore(self):
+        """Stop sorting and displaying the liststore, to add many rows."""
+        self.liststore.set_sort_column_id(UNSORTED, Gtk.SortType.ASCENDING)
+        get_obj('photos_view').set_model(None)
+    
+    def attach_liststore(self, reselect):
+        """Sort and display the liststore again, reselecting those photos."""
+        get_obj('photos_view').set_model(self.liststore)
+        self.liststore.set_sort_column_id(TIMESTAMP, Gtk.SortType.ASCENDING)
+        self.labels.select([photo for photo in reselect
+                            if photos.get(photo.filename) is photo])
     
-    def load_gpx_from_file(self, uri):
-        """Parse GPX data, drawing each GPS track segment on the map."""
+    def load_gpx_from_file(self, uri, open_file=None):
+        """Parse GPX data, drawing each GPS track segment on the map.
+        
+        open_file is the TrackFile subclass to parse the file with, which is
+        determined by sniffing the file if not given. Raises IOError if the
+        file is not a GPS track.
+        
+        If this file was loaded before and has since only had data appended
+        onto it, then just the new data is parsed, extending the existing
+        tracks, and only those photos that fall within the newly covered
+        span of time are repositioned.
+        """
         start_time = clock()
         
-        open_file = KMLFile if uri[-3:].lower() == 'kml' else GPXFile
-        gpx = open_file(uri, self.progressbar)
+        gpx = trackfiles.get(uri)
+        previous = gpx.omega if gpx is not None else None
+        new = gpx.update() if gpx is not None else None
+        if new is None:
+            open_file = open_file or sniff(uri)
+            if open_file in (None, Photograph):
+                raise IOError
+            gpx = open_file(uri, self.progressbar)
+            new = gpx.tracks
+            previous = None
+            trackfiles[uri] = gpx
         
         # Emitting this signal ensures the new tracks get the correct color.
         get_obj('colorselection').emit('color-changed')
         
         self.status_message(_('%d points loaded in %.2fs.') %
-            (len(gpx.tracks), clock() - start_time), True)
+            (len(new), clock() - start_time), True)
         
         if len(gpx.tracks) < 2:
             return
         
-        points.update(gpx.tracks)
+        points.update(new)
         metadata.alpha = min(metadata.alpha, gpx.alpha)
         metadata.omega = max(metadata.omega, gpx.omega)
         
+        if previous is not None:
+            if new:
+                self.extend_timestamp_comparison(min(previous, min(new)),
+                                                 max(new))
+            return
+        
         map_view.emit('realize')
         map_view.set_zoom_level(map_view.get_max_zoom_level())
         bounds = Champlain.BoundingBox.new()
@@ -147,6 +299,17 @@ class GottenGeography():
         self.prefs.set_timezone()
         gpx_sensitivity()
     
+    def extend_timestamp_comparison(self, start, end):
+        """Reposition only the photos taken between start and end.
+        
+        Photos taken after the end of the track are also included if end is
+        the final point, because they were pinned to the old final point.
+        """
+        for photo in photos.values():
+            stamp = track_time(photo)
+            if start <= stamp and (stamp <= end or end >= metadata.omega):
+                auto_timestamp_comparison(photo)
+    
     def apply_selected_photos(self, button, view):
         """Manually apply map center coordinates to all selected photos."""
         for photo in selected:
@@ -154,44 +317,93 @@ class GottenGeography():
             photo.set_location(
                 view.get_property('latitude'),
                 view.get_property('longitude'))
-        self.labels.selection.emit('changed')
+        refresh(self.labels.selection)
     
     def revert_selected_photos(self, button=None):
-        """Discard any modifications to all selected photos."""
-        self.open_files([photo.filename for photo in modified & selected])
+        """Discard any modifications to all selected photos.
+        
+        Photos are restored from what was remembered when they were loaded or
+        saved, only those that have since been changed on disk by some other
+        program are read again.
+        """
+        stale = []
+        for photo in modified & selected:
+            if photo.revert():
+                photo.position_label()
+                modified.discard(photo)
+                self.liststore.set_value(photo.iter, SUMMARY,
+                    photo.long_summary())
+                auto_timestamp_comparison(photo)
+            else:
+                stale.append(photo.filename)
+        self.open_files(stale)
     
     def close_selected_photos(self, button=None):
-        """Discard all selected photos."""
-        for photo in selected.copy():
-            self.labels.layer.remove_marker(photo.label)
-            del photos[photo.filename]
-            modified.discard(photo)
-            self.liststore.remove(photo.iter)
+        """Discard all selected photos.
+        
+        The selection is cleared first, so that it only changes once instead
+        of once per photo. Closing every photo clears the liststore and the
+        map all at once, and closing many of them detaches the liststore
+        while their rows are removed.
+        """
+        closing = selected.copy()
+        everything = len(closing) == len(photos)
+        bulk = not everything and len(closing) >= BULK_MINIMUM
+        known_change(dict.fromkeys(closing, False),
+                     self.labels.selection.unselect_all)
+        if everything:
+            self.labels.layer.remove_all()
+            self.liststore.clear()
+        if bulk:
+            self.detach_liststore()
+        try:
+            for photo in closing:
+                if not everything:
+                    self.labels.layer.remove_marker(photo.label)
+                    self.liststore.remove(photo.iter)
+                del photos[photo.filename]
+                self.thumbs.forget(photo.filename)
+                modified.discard(photo)
+        finally:
+            if bulk:
+                self.attach_liststore([])
         self.labels.select_all.set_active(False)
     
     def save_all_files(self, widget=None):
-        """Ensure all loaded files are saved."""
+        """Ensure all loaded files are saved.
+        
+        The files are written by worker processes, and the interface is
+        redrawn while waiting on them, with each file being reported on as
+        soon as it has been saved. Photos that would be saved with exactly
+        the same tags that they already have aren't written at all.
+        """
         self.progressbar.show()
+        for photo in [photo for photo in modified if photo.unchanged()]:
+            modified.discard(photo)
+            self.liststore.set_value(photo.iter, SUMMARY, photo.long_summary())
         total = len(modified)
-        for i, photo in enumerate(list(modified), 1):
-            self.redraw_interface(i / total, basename(photo.filename))
-            try:
-                photo.write()
-            except Exception as inst:
-                self.status_message(str(inst))
-            else:
+        jobs = [photo.geotags() for photo in modified]
+        saved = save_all(jobs, self.redraw_interface,
+                         gst.get_boolean('xmp-sidecars'))
+        for i, (filename, error) in enumerate(saved, 1):
+            self.redraw_interface(i / total, basename(filename))
+            photo = photos.get(filename)
+            if error is not None:
+                self.status_message(error)
+            elif photo is not None:
+                photo.remember()
                 modified.discard(photo)
                 self.liststore.set_value(photo.iter, SUMMARY,
                     photo.long_summary())
         self.progressbar.hide()
-        self.labels.selection.emit('changed')
+        refresh(self.labels.selection)
     
 ################################################################################
 # Data manipulation. These methods modify the loaded files in some way.
 ################################################################################
     
     def time_offset_changed(self, widget):
-        """Update all photos each time the camera's clock is corrected."""
+        """Record the corrected camera clock, and schedule moving photos."""
         seconds = self.secbutton.get_value()
         minutes = self.minbutton.get_value()
         offset  = int((minutes * 60) + seconds)
@@ -201,14 +413,64 @@ class GottenGeography():
                 minutes += seconds / 60
                 self.secbutton.set_value(0)
                 self.minbutton.set_value(minutes)
-            for photo in photos.values():
-                auto_timestamp_comparison(photo)
+            if self.offset_source is None:
+                self.offset_source = GLib.timeout_add(OFFSET_DELAY,
+                                                      self.apply_time_offset)
+    
+    def apply_time_offset(self):
+        """Move the photos whose positions changed with the clock offset.
+        
+        Holding down a spinbutton changes the offset many times a second, so
+        this happens at most once per OFFSET_DELAY, and photos that stay put
+        aren't geocoded or redrawn again.
+        """
+        self.offset_source = None
+        for photo in photos.values():
+            position = auto_position(photo)
+            if position is not None and position != (
+                    photo.latitude, photo.longitude, photo.altitude):
+                photo.set_location(*position)
+        return False
+    
+    def estimate_clock_offset(self, button=None):
+        """Set the clock offset to whatever best fits the geotagged photos."""
+        offset = estimate_offset()
+        if offset is None:
+            self.status_message(_('No photos were geotagged already.'))
+            return
+        minutes, seconds = divmod(abs(offset), 60)
+        sign = -1 if offset < 0 else 1
+        self.minbutton.set_value(sign * minutes)
+        self.secbutton.set_value(sign * seconds)
+    
+    def sidecars_changed(self, *ignored):
+        """Forget what was saved, since it was saved somewhere else."""
+        for photo in photos.values():
+            photo.forget()
     
     def modify_summary(self, photo):
-        """Insert the current photo summary into the liststore."""
+        """Mark the photo as modified, and queue it's summary for redrawing.
+        
+        Moving many photos at once would otherwise redraw the liststore row
+        of each one as it's moved, so the summaries are updated together
+        once the interface is idle.
+        """
         modified.add(photo)
-        self.liststore.set_value(photo.iter, SUMMARY,
-            ('<b>%s</b>' % photo.long_summary()))
+        self.dirty.add(photo)
+        if self.summary_source is None:
+            self.summary_source = GLib.idle_add(self.update_summaries)
+    
+    def update_summaries(self):
+        """Insert the current summaries of changed photos into the liststore."""
+        self.summary_source = None
+        for photo in self.dirty:
+            if photos.get(photo.filename) is photo:
+                summary = photo.long_summary()
+                if photo in modified:
+                    summary = '<b>%s</b>' % summary
+                self.liststore.set_value(photo.iter, SUMMARY, summary)
+        self.dirty.clear()
+        return False
     
 ################################################################################
 # Dialogs. Various dialog-related methods for user interaction.
@@ -221,7 +483,8 @@ class GottenGeography():
         try:
             photo = Photograph(chooser.get_preview_filename(),
                                lambda x: None, 300)
-            photo.read()
+            photo.read(sidecars=gst.get_boolean('xmp-sidecars'))
+            photo.read_thumbnail()
         except IOError:
             return
         image.set_from_pixbuf(photo.thumb)
@@ -271,16 +534,18 @@ class GottenGeography():
         
         self.liststore = get_obj('loaded_photos')
         self.liststore.set_sort_column_id(TIMESTAMP, Gtk.SortType.ASCENDING)
+        self.dirty = set()
+        self.summary_source = None
+        self.camera_views = {}
         
         cell_string = Gtk.CellRendererText()
         cell_thumb  = Gtk.CellRendererPixbuf()
-        cell_thumb.set_property('stock-id', Gtk.STOCK_MISSING_IMAGE)
         cell_thumb.set_property('ypad', 6)
         cell_thumb.set_property('xpad', 12)
         
         column = Gtk.TreeViewColumn('Photos')
         column.pack_start(cell_thumb, False)
-        column.add_attribute(cell_thumb, 'pixbuf', THUMB)
+        column.set_cell_data_func(cell_thumb, show_thumbnail)
         column.pack_start(cell_string, False)
         column.add_attribute(cell_string, 'markup', SUMMARY)
         column.set_sizing(Gtk.TreeViewColumnSizing.AUTOSIZE)
@@ -293,6 +558,7 @@ class GottenGeography():
         self.prefs     = PreferencesController()
         self.labels    = LabelController()
         self.actors    = ActorController()
+        self.thumbs    = ThumbnailController()
         
         about = get_obj('about')
         about.set_version(REVISION)
@@ -304,6 +570,7 @@ class GottenGeography():
             'open_button':       [self.add_files_dialog, get_obj('open')],
             'save_button':       [self.save_all_files],
             'clear_button':      [clear_all_gpx],
+            'estimate_button':   [self.estimate_clock_offset],
             'close_button':      [self.close_selected_photos],
             'revert_button':     [self.revert_selected_photos],
             'about_button':      [lambda b, d: d.run() and d.hide(), about],
@@ -330,10 +597,11 @@ class GottenGeography():
         accel.connect(Gdk.keyval_from_name('q'),
             Gdk.ModifierType.CONTROL_MASK, 0, self.confirm_quit_dialog)
         
-        self.labels.selection.emit('changed')
+        refresh(self.labels.selection)
         clear_all_gpx()
         
         metadata.delta = 0
+        self.offset_source = None
         self.secbutton, self.minbutton = get_obj('seconds'), get_obj('minutes')
         for spinbutton in [ self.secbutton, self.minbutton ]:
             spinbutton.connect('value-changed', self.time_offset_changed)
@@ -341,6 +609,7 @@ class GottenGeography():
         gst.bind('offset-seconds', self.secbutton, 'value')
         
         gst.bind('left-pane-page', get_obj('photo_camera_gps'), 'page')
+        gst.connect('changed::xmp-sidecars', self.sidecars_changed)
         
         get_obj('open').connect('update-preview', self.update_preview,
             get_obj('preview_label'), get_obj('preview_image'))
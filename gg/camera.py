@@ -21,32 +21,165 @@ A 'relocatable' GSettings schema is used to persist this data across application
 launches.
 """
 
-from gi.repository import Gio
+from gi.repository import Gtk, Gio, GLib
+from gettext import gettext as _
 
 from version import PACKAGE
+from territories import tz_regions, get_timezone
+from timestamps import clock, get_zone
+from common import photos, calculate_timestamps, auto_timestamp_comparison
+
+# The EXIF keys that together identify an individual camera.
+KEYS = ['Exif.Image.Make', 'Exif.Image.Model',
+        'Exif.Image.CameraSerialNumber', 'Exif.Photo.BodySerialNumber']
+
+# Cameras that have been seen already, by their camera_id.
+cameras = {}
+
+# Milliseconds to collect setting changes for before moving a camera's photos.
+CHANGE_DELAY = 50
+
+# The ways that a camera's timezone can be chosen, and their descriptions.
+TIMEZONE_METHODS = (
+    ('default', _('Preferred timezone')),
+    ('system',  _('System timezone')),
+    ('lookup',  _('GPX timezone')),
+    ('custom',  _('Specific timezone:')),
+)
+
+
+def camera_names(found):
+    """Fill in the make and model for cameras that don't record them."""
+    names = {'Make': 'Unknown Make', 'Model': 'Unknown Camera'}
+    names.update(found)
+    return names
+
+def camera_id(names):
+    """Combine the identifying values into a single, GSettings safe id."""
+    return '_'.join(sorted(names.values())).lower().replace(' ', '_')
+
+def get_camera(found):
+    """Find the Camera for the given values, creating it only once.
+    
+    Most photos come from just a few cameras, so this avoids creating a
+    GSettings object, and writing to dconf, for every single photo.
+    """
+    names = camera_names(found)
+    key = camera_id(names)
+    if key not in cameras:
+        cameras[key] = Camera(names, key)
+    return cameras[key]
+
 
 # TODO: subclass from GObject so that we can bind properties to settings easily.
 class Camera():
     """Store per-camera configuration in GSettings."""
     
-    def __init__(self, exif):
-        names = {'Make': 'Unknown Make', 'Model': 'Unknown Camera'}
-        keys = ['Exif.Image.' + key for key in names.keys()
-            + ['CameraSerialNumber']] + ['Exif.Photo.BodySerialNumber']
-        
-        for key in keys:
-            try:
-                names.update({key.split('.')[-1]: exif[key].value})
-            except KeyError:
-                pass
-        
-        camera_id = '_'.join(sorted(names.values())).lower().replace(' ', '_')
-        
+    def __init__(self, names, camera_id):
+        """names maps the last part of each of the KEYS to it's value."""
+        self.id = camera_id
         self.gst = Gio.Settings.new_with_path(
             'ca.exolucere.%s.camera' % PACKAGE,
             '/ca/exolucere/%s/cameras/%s/'
                 % (PACKAGE, camera_id))
         
-        self.gst.set_string('make', names['Make'])
-        self.gst.set_string('model', names['Model'])
+        for key, name in (('make', names['Make']), ('model', names['Model'])):
+            if self.gst.get_string(key) != name:
+                self.gst.set_string(key, name)
+        
+        self.offset = 0
+        self.method = 'default'
+        self.custom = None
+        self.system = None
+        self.source = None
+        self.update()
+        self.gst.connect('changed', self.changed)
+    
+    def changed(self, *ignored):
+        """Read the new settings, and schedule moving this camera's photos."""
+        self.update()
+        if self.source is None:
+            self.source = GLib.timeout_add(CHANGE_DELAY, self.apply)
+    
+    def apply(self):
+        """Recalculate the timestamps and positions of this camera's photos."""
+        self.source = None
+        calculate_timestamps(self)
+        for photo in photos.values():
+            if photo.camera is self:
+                auto_timestamp_comparison(photo)
+        return False
+    
+    def update(self, *ignored):
+        """Read the clock offset and timezone settings from GSettings."""
+        self.offset = self.gst.get_int('offset')
+        self.method = self.gst.get_string('timezone-method')
+        self.system = get_zone() if self.method == 'system' else None
+        self.custom = None
+        region = self.gst.get_int('timezone-region')
+        city   = self.gst.get_int('timezone-cities')
+        if self.method == 'custom' and 0 <= region < len(tz_regions):
+            cities = get_timezone(tz_regions[region])
+            if 0 <= city < len(cities):
+                self.custom = get_zone('%s/%s' % (tz_regions[region],
+                                                  cities[city]))
+    
+    def timezone(self):
+        """Find the timezone that this camera's clock is set to.
+        
+        Cameras that haven't been given a timezone of their own use the one
+        chosen in the preferences.
+        """
+        if self.method == 'system':
+            return self.system
+        if self.method == 'lookup' and clock.lookup is not None:
+            return clock.lookup
+        if self.method == 'custom' and self.custom is not None:
+            return self.custom
+        return clock.zone
+
 
+class CameraView(Gtk.HBox):
+    """Let the user set the clock offset and timezone of one camera."""
+    
+    def __init__(self, camera):
+        Gtk.HBox.__init__(self, spacing=6)
+        self.camera = camera
+        
+        offset = Gtk.SpinButton.new_with_range(-3600, 3600, 1)
+        offset.set_tooltip_text(
+            _("The number of seconds that this camera's clock is wrong by."))
+        method = Gtk.ComboBoxText()
+        for choice, description in TIMEZONE_METHODS:
+            method.append(choice, description)
+        region = Gtk.ComboBoxText()
+        for name in tz_regions:
+            region.append(name, name)
+        cities = Gtk.ComboBoxText()
+        region.connect('changed', self.region_changed, cities)
+        method.connect('changed', self.method_changed, region, cities)
+        
+        flags = Gio.SettingsBindFlags.DEFAULT
+        camera.gst.bind('offset', offset, 'value', flags)
+        camera.gst.bind('timezone-method', method, 'active-id', flags)
+        camera.gst.bind('timezone-region', region, 'active', flags)
+        camera.gst.bind('timezone-cities', cities, 'active', flags)
+        
+        self.pack_start(Gtk.Label('%s %s' % (camera.gst.get_string('make'),
+            camera.gst.get_string('model'))), False, False, 0)
+        for widget in (offset, method, region, cities):
+            self.pack_start(widget, False, False, 0)
+        self.method_changed(method, region, cities)
+        self.show_all()
+    
+    def region_changed(self, region, cities):
+        """Populate the list of cities when a continent is selected."""
+        cities.remove_all()
+        for city in get_timezone(region.get_active_id(), []):
+            cities.append(city, city)
+    
+    def method_changed(self, method, region, cities):
+        """Only offer the region and city for a specific timezone."""
+        specific = method.get_active_id() == 'custom'
+        region.set_sensitive(specific)
+        cities.set_sensitive(specific)
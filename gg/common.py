@@ -27,13 +27,19 @@ is used to place photos on the map by looking up their timestamps.
 
 The `photos` dict maps absolute filename paths to Photograph() instances, and
 is used for most of the photo manipulations (eg, loading, saving, etc).
+
+The `trackfiles` dict maps absolute filename paths to TrackFile() instances,
+so that GPS logs which have grown since they were loaded can be extended
+instead of being loaded all over again.
 """
 
 from __future__ import division
 
 from gi.repository import Gtk, Gio, GLib
 from gi.repository import GtkChamplain, Champlain
+from math import cos, hypot, radians
 from os.path import join
+from bisect import bisect
 
 from build_info import PKG_DATA_DIR
 from version import PACKAGE
@@ -44,6 +50,15 @@ modified = set()
 polygons = []
 points   = {}
 photos   = {}
+trackfiles = {}
+
+# Handy names for GtkListStore column numbers.
+PATH, SUMMARY, THUMB, TIMESTAMP = range(4)
+
+# Clock offsets are first estimated to the nearest this many seconds, and
+# then to the nearest second, using at most this many geotagged photos.
+ESTIMATE_STEP   = 60
+ESTIMATE_SAMPLE = 200
 
 
 class metadata:
@@ -54,47 +69,124 @@ class metadata:
     delta = 0
     omega = float('-inf')
     alpha = float('inf')
+    index = []
+
+
+def track_index():
+    """List the timestamps of all the track points, in order.
+    
+    Loading more points always adds new timestamps, so the list only needs
+    to be sorted again when the number of points has changed.
+    """
+    if len(metadata.index) != len(points):
+        metadata.index = sorted(points)
+    return metadata.index
+
+def interpolate(stamp):
+    """Find the latitude, longitude and elevation at the given time.
+    
+    stamp must be within the first and last track points.
+    """
+    try:
+        point = points[stamp] # Try to use an exact match,
+        return point.lat, point.lon, point.ele
+    except KeyError:
+        pass
+    
+    # Find the two points that are nearest (in time) to the photo.
+    index = track_index()
+    position = bisect(index, stamp)
+    lo, hi = index[position - 1], index[position]
+    hi_point = points[hi]
+    lo_point = points[lo]
+    hi_ratio = (stamp - lo) / (hi - lo)  # Proportional amount of time
+    lo_ratio = (hi - stamp) / (hi - lo)  # between each point & the photo.
+    
+    # Find intermediate values using the proportional ratios.
+    return (((lo_point.lat * lo_ratio)  +
+             (hi_point.lat * hi_ratio)),
+            ((lo_point.lon * lo_ratio)  +
+             (hi_point.lon * hi_ratio)),
+            ((lo_point.ele * lo_ratio)  +
+             (hi_point.ele * hi_ratio)))
 
 
 # This function is the embodiment of my applications core logic.
 # Everything else is just implementation details.
-def auto_timestamp_comparison(photo):
-    """Use GPX data to calculate photo coordinates and elevation."""
+def track_time(photo):
+    """Find when the GPS says the photo was taken, in epoch seconds.
+    
+    This is the photo timestamp plus the user-specified clock offset
+    (metadata.delta) and the camera's own offset, just like the keys of the
+    'points' dict.
+    """
+    return metadata.delta + photo.offset() + photo.timestamp
+
+def auto_position(photo):
+    """Use GPX data to calculate photo coordinates and elevation.
+    
+    Returns None if the photo was placed manually or there's no GPX data.
+    """
     if photo.manual or len(points) < 2:
-        return
+        return None
     
-    # Add the user-specified clock offset (metadata.delta) to the photo
-    # timestamp, and then keep it within the range of available GPX points.
-    # The result is in epoch seconds, just like the keys of the 'points' dict.
-    stamp = min(max(
-        metadata.delta + photo.timestamp,
-        metadata.alpha),
-        metadata.omega)
+    # Keep the corrected timestamp within the range of available GPX points.
+    stamp = min(max(track_time(photo), metadata.alpha), metadata.omega)
     
-    try:
-        point = points[stamp] # Try to use an exact match,
-        lat   = point.lat     # if such a thing were to exist.
-        lon   = point.lon     # It's more likely than you think. 50%
-        ele   = point.ele     # of the included demo data matches here.
+    return interpolate(stamp)
+
+def auto_timestamp_comparison(photo):
+    """Move the photo to where the GPX data says it was taken."""
+    position = auto_position(photo)
+    if position is not None:
+        photo.set_location(*position)
+
+def estimate_offset(limit=3600):
+    """Find the clock offset that best fits the photos that have GPS tags.
     
-    except KeyError:
-        # Find the two points that are nearest (in time) to the photo.
-        hi = min([point for point in points if point > stamp])
-        lo = max([point for point in points if point < stamp])
-        hi_point = points[hi]
-        lo_point = points[lo]
-        hi_ratio = (stamp - lo) / (hi - lo)  # Proportional amount of time
-        lo_ratio = (hi - stamp) / (hi - lo)  # between each point & the photo.
-        
-        # Find intermediate values using the proportional ratios.
-        lat = ((lo_point.lat * lo_ratio)  +
-               (hi_point.lat * hi_ratio))
-        lon = ((lo_point.lon * lo_ratio)  +
-               (hi_point.lon * hi_ratio))
-        ele = ((lo_point.ele * lo_ratio)  +
-               (hi_point.ele * hi_ratio))
+    Photos that were already geotagged when they were first loaded, eg by a
+    camera with it's own GPS, show where the track must have been when they
+    were taken. Positions that were found by this program are never used,
+    even once they've been saved. Each candidate offset is scored by how far those photos would be
+    from where the track places them, first in steps of ESTIMATE_STEP and then
+    second by second around the best step. Returns None if there's nothing to
+    compare against.
+    """
+    known = [(photo.timestamp + photo.offset(),) + photo.geotagged
+             for photo in photos.values() if photo.geotagged is not None]
+    if len(points) < 2 or not known:
+        return None
+    known = known[::max(len(known) // ESTIMATE_SAMPLE, 1)]
     
-    photo.set_location(lat, lon, ele)
+    def score(delta):
+        """Add up how far the photos are from the track, roughly in degrees."""
+        total = 0
+        for stamp, lat, lon in known:
+            track_lat, track_lon, ele = interpolate(
+                min(max(stamp + delta, metadata.alpha), metadata.omega))
+            total += hypot(track_lat - lat,
+                           (track_lon - lon) * cos(radians(lat)))
+        return total, abs(delta)
+    
+    best = min(range(-limit, limit + 1, ESTIMATE_STEP), key=score)
+    return min(range(max(best - ESTIMATE_STEP, -limit),
+                     min(best + ESTIMATE_STEP, limit) + 1), key=score)
+
+def calculate_timestamps(only=None):
+    """Recalculate the timestamps of all photos, one camera at a time.
+    
+    Each camera's timezone is only determined once, and then applied to every
+    photo taken with it. If only is given, just that camera's photos are
+    recalculated.
+    """
+    cameras = {}
+    for photo in photos.values():
+        if only is None or photo.camera is only:
+            cameras.setdefault(photo.camera, []).append(photo)
+    for camera, group in cameras.items():
+        zone = camera.timezone() if camera is not None else None
+        for photo in group:
+            photo.calculate_timestamp(zone)
 
 
 class Builder(Gtk.Builder):
@@ -206,6 +298,8 @@ def clear_all_gpx(widget=None):
     
     del polygons[:]
     points.clear()
+    trackfiles.clear()
+    metadata.index = []
     metadata.omega = float('-inf')   # Final GPX track point
     metadata.alpha = float('inf')    # Initial GPX track point
     gpx_sensitivity()
@@ -214,4 +308,5 @@ def gpx_sensitivity():
     """Control the sensitivity of GPX-related widgets."""
     gpx_sensitive = len(points) > 0
     get_obj('clear_button').set_sensitive(gpx_sensitive)
+    get_obj('estimate_button').set_sensitive(gpx_sensitive)
 
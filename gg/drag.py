@@ -38,6 +38,7 @@ from gi.repository import Gtk, Gdk
 from urlparse import urlparse
 
 from common import Struct, get_obj, map_view, selected, modified, photos
+from label import refresh
 
 class DragController():
     """Control the drag & drop behavior."""
@@ -94,6 +95,6 @@ class DragController():
                         map_view.x_to_longitude(x))
                     modified.add(photo)
         
-        self.selection.emit('changed')
+        refresh(self.selection)
         map_view.emit('animation-completed')
 
@@ -0,0 +1,150 @@
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Decode the record messages out of Garmin's binary FIT activity files.
+
+FIT files consist of definition messages, which describe the layout of the
+data messages that follow them. Each definition is compiled into a single
+struct.Struct that unpacks only the fields we care about and skips over
+everything else, and the decoded values are appended directly onto typed
+arrays, so no objects are created for individual records.
+
+The file's CRC is not verified, because doing so in pure Python would cost
+far more than decoding the file does.
+"""
+
+from __future__ import division
+
+from struct import Struct, calcsize, unpack_from, error as StructError
+from array import array
+
+# FIT timestamps count seconds from 1989-12-31 00:00:00 UTC.
+FIT_EPOCH = 631065600
+
+# Latitude and longitude are stored as 'semicircles'.
+SEMICIRCLE = 180 / 2**31
+
+# Global message number of the 'record' message, and it's useful fields.
+RECORD = 20
+TIMESTAMP, LATITUDE, LONGITUDE, ALTITUDE, ENHANCED_ALTITUDE = \
+    253, 0, 1, 2, 78
+FIELDS = (TIMESTAMP, LATITUDE, LONGITUDE, ALTITUDE, ENHANCED_ALTITUDE)
+
+# Values that mean 'no data' for the field types used above.
+INVALID = (0xFFFFFFFF, 0x7FFFFFFF, 0xFFFF)
+
+# Struct format characters for each of the FIT base types.
+BASE_TYPES = {
+    0x00: 'B', 0x01: 'b', 0x02: 'B', 0x83: 'h', 0x84: 'H', 0x85: 'i',
+    0x86: 'I', 0x88: 'f', 0x89: 'd', 0x0A: 'B', 0x8B: 'H', 0x8C: 'I',
+    0x8E: 'q', 0x8F: 'Q', 0x90: 'Q',
+}
+
+
+def compile_definition(endian, fields, extra):
+    """Build a Struct that unpacks only the record fields we care about.
+    
+    Returns the Struct and a tuple containing the index into the unpacked
+    values of each of the FIELDS, or None if that field is missing.
+    """
+    layout, order = [endian], []
+    for number, size, base in fields:
+        code = BASE_TYPES.get(base)
+        if number in FIELDS and code and calcsize(endian + code) == size:
+            layout.append(code)
+            order.append(number)
+        else:
+            layout.append('%dx' % size)
+    if extra:
+        layout.append('%dx' % extra)
+    return Struct(''.join(layout)), tuple(
+        [order.index(field) if field in order else None for field in FIELDS])
+
+def decode(data):
+    """Decode the track points from the contents of a FIT file.
+    
+    Returns parallel arrays of timestamps (in UTC epoch seconds), latitudes,
+    longitudes and elevations. Raises IOError if data isn't a FIT file.
+    """
+    if len(data) < 12 or data[8:12] != '.FIT':
+        raise IOError
+    position = ord(data[0])
+    end = min(position + unpack_from('<I', data, 4)[0], len(data))
+    
+    times, elevations = array('l'), array('d')
+    latitudes, longitudes = array('d'), array('d')
+    definitions = {}
+    timestamp = 0
+    
+    try:
+        while position < end:
+            header = ord(data[position])
+            position += 1
+            
+            if header & 0x80:
+                # Compressed timestamp header, holds the low five bits of
+                # the timestamp, which rolls over every 32 seconds.
+                local = (header >> 5) & 0x03
+                offset = header & 0x1F
+                timestamp = (timestamp & ~0x1F) + offset + (
+                    0x20 if offset < (timestamp & 0x1F) else 0)
+            
+            elif header & 0x40:
+                # Definition message, describes the local message type.
+                endian = '>' if ord(data[position + 1]) else '<'
+                message, count = unpack_from(endian + 'HB', data, position + 2)
+                position += 5
+                fields = [unpack_from('BBB', data, position + i * 3)
+                          for i in range(count)]
+                position += count * 3
+                extra = 0
+                if header & 0x20:
+                    # Developer fields, which we just need to skip over.
+                    developer = ord(data[position])
+                    extra = sum([ord(data[position + 2 + i * 3])
+                                 for i in range(developer)])
+                    position += 1 + developer * 3
+                definitions[header & 0x0F] = (message,) + \
+                    compile_definition(endian, fields, extra)
+                continue
+            
+            else:
+                local = header & 0x0F
+            
+            message, layout, indexes = definitions[local]
+            if message == RECORD:
+                values = layout.unpack_from(data, position)
+                stamp, lat, lon, alt, enhanced = indexes
+                if stamp is not None:
+                    timestamp = values[stamp]
+                if lat is not None and lon is not None and \
+                   values[lat] not in INVALID and values[lon] not in INVALID:
+                    ele = 0.0
+                    if enhanced is not None and \
+                       values[enhanced] not in INVALID:
+                        ele = values[enhanced] / 5 - 500
+                    elif alt is not None and values[alt] not in INVALID:
+                        ele = values[alt] / 5 - 500
+                    times.append(timestamp + FIT_EPOCH)
+                    latitudes.append(values[lat] * SEMICIRCLE)
+                    longitudes.append(values[lon] * SEMICIRCLE)
+                    elevations.append(ele)
+            position += layout.size
+    except (KeyError, IndexError, StructError):
+        # Undefined local message types or truncated data, so the
+        # file is corrupt, but we can still use what was decoded so far.
+        pass
+    
+    return times, latitudes, longitudes, elevations
@@ -18,7 +18,6 @@
 from __future__ import division
 
 from math import acos, sin, cos, radians
-from time import strftime, localtime
 from math import modf as split_float
 from os.path import join, basename
 from gettext import gettext as _
@@ -26,6 +25,7 @@ from fractions import Fraction
 from pyexiv2 import Rational
 
 from territories import get_state, get_country
+from timestamps import clock
 from build_info import PKG_DATA_DIR
 
 EARTH_RADIUS = 6371 #km
@@ -71,11 +71,13 @@ def format_coords(lat, lon):
     )
 
 
-class Coordinates():
+class BaseCoordinates(object):
     """A generic object containing latitude and longitude coordinates.
     
-    This class is inherited by Photograph and TrackFile and contains methods
-    required by both of those classes.
+    This class is inherited by Photograph and TrackFile (by way of
+    Coordinates) and contains methods required by both of those classes.
+    It has no __dict__, so that Photograph can use __slots__ to keep the
+    memory used by each of it's many instances down.
     
     The geodata attribute of this class is shared across all instances of
     all subclasses of this class. When it is modified by any instance, the
@@ -86,6 +88,8 @@ class Coordinates():
     looked up by another instance of any subclass.
     """
     
+    __slots__ = ()
+    
     provincestate = None
     countrycode   = None
     countryname   = None
@@ -112,7 +116,7 @@ class Coordinates():
         """Search cities.txt for nearest city."""
         if not self.valid_coords():
             return
-        assert self.geodata is Coordinates.geodata
+        assert self.geodata is BaseCoordinates.geodata
         key = '%.2f,%.2f' % (self.latitude, self.longitude)
         if key in self.geodata:
             return self.set_geodata(self.geodata[key])
@@ -145,7 +149,7 @@ class Coordinates():
     def pretty_time(self):
         """Convert epoch seconds to a human-readable date."""
         if type(self.timestamp) is int:
-            return strftime('%Y-%m-%d %X', localtime(self.timestamp))
+            return clock.zone.format(self.timestamp)
     
     def pretty_coords(self):
         """Add cardinal directions to decimal coordinates."""
@@ -175,3 +179,6 @@ class Coordinates():
             'style="italic" size="smaller"', self.short_summary()
         )
 
+
+class Coordinates(BaseCoordinates):
+    """Coordinates that can be given any attributes, unlike BaseCoordinates."""
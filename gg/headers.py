@@ -0,0 +1,427 @@
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Read just the metadata that we need straight out of JPEG and TIFF headers.
+
+pyexiv2 parses every tag in a file, including maker notes and previews, which
+means reading most of the file from disk. Here, JPEGs are read one segment at
+a time, stopping at the start of the image data, and only the IFDs that hold
+interesting tags are read out of TIFF based files (which includes most RAW
+formats), so usually only the first few KB of each file are ever read.
+
+Anything that can't be read this way raises IOError, so that the caller can
+fall back on pyexiv2, which is still used for writing.
+
+Photos that already have a GPS IFD can also have their GPS tags overwritten
+in place, as long as the new values are the same size as the old ones, which
+they nearly always are. Only those few bytes are written, instead of the
+whole file.
+"""
+
+from __future__ import division
+
+from struct import calcsize, pack, unpack, unpack_from, error as StructError
+from fractions import Fraction
+from time import strptime
+from os import fstat, fsync
+
+from gpsmath import dms_to_decimal
+
+# Leading bytes of the TIFF based formats, including ORF and RW2.
+TIFF_MAGIC = ('II*\x00', 'MM\x00*', 'IIRO', 'IIRS', 'IIU\x00')
+
+# This much of a TIFF file is read up front, hopefully including every IFD.
+HEADER_SIZE = 65536
+
+# Struct format characters for the TIFF field types, ASCII and UNDEFINED
+# values are kept as strings.
+TYPES = {
+    1: 'B', 3: 'H', 4: 'I', 5: 'II', 6: 'b', 8: 'h', 9: 'i', 10: 'ii',
+    11: 'f', 12: 'd', 13: 'I',
+}
+
+# Tags pointing to other IFDs.
+EXIF_IFD, GPS_IFD, SUB_IFDS = 0x8769, 0x8825, 0x014A
+
+# Tags that we care about, and the keys that they're returned as.
+CAMERA = {
+    (0, 0x010F): 'Make',
+    (0, 0x0110): 'Model',
+    (0, 0xC62F): 'CameraSerialNumber',
+    (EXIF_IFD, 0xA431): 'BodySerialNumber',
+}
+DATE_TIME_ORIGINAL = 0x9003
+LATITUDE_REF, LATITUDE, LONGITUDE_REF, LONGITUDE = 1, 2, 3, 4
+ALTITUDE_REF, ALTITUDE = 5, 6
+MAP_DATUM = 18
+PREVIEW_OFFSET, PREVIEW_LENGTH = 0x0201, 0x0202
+NEW_SUBFILE_TYPE, COMPRESSION = 0x00FE, 0x0103
+STRIP_OFFSETS, STRIP_BYTE_COUNTS = 0x0111, 0x0117
+
+# Compression values of JPEG strips, old style JPEG is what CR2 uses for the
+# preview in it's IFD0. New style JPEG also covers the lossless JPEG of RAW
+# image data, so it's only a preview in a reduced resolution subfile.
+OLD_JPEG, JPEG = 6, 7
+REDUCED_RESOLUTION = 1
+IPTC_NAA, PHOTOSHOP = 0x83BB, 0x8649
+
+# IPTC datasets in the application record, by their pyexiv2 names.
+IPTC = {90: 'City', 95: 'ProvinceState', 100: 'CountryCode',
+        101: 'CountryName'}
+
+# GPS tags that can be patched, by their pyexiv2 names.
+GPS = {'LatitudeRef': LATITUDE_REF, 'Latitude': LATITUDE,
+       'LongitudeRef': LONGITUDE_REF, 'Longitude': LONGITUDE,
+       'AltitudeRef': ALTITUDE_REF, 'Altitude': ALTITUDE,
+       'MapDatum': MAP_DATUM}
+
+
+class TIFFReader():
+    """Read values out of the IFDs of a TIFF structure.
+    
+    Offsets are relative to base, which is where the TIFF header is in the
+    file. Reads that fall within the cached bytes don't touch the disk.
+    """
+    
+    def __init__(self, stream, base, cached):
+        self.stream = stream
+        self.base   = base
+        self.cached = cached
+        byte_order  = cached[:2]
+        if byte_order == 'II':
+            self.endian = '<'
+        elif byte_order == 'MM':
+            self.endian = '>'
+        else:
+            raise IOError
+    
+    def read(self, offset, length):
+        """Read length bytes at offset, raising IOError if there aren't any."""
+        if offset + length <= len(self.cached):
+            return self.cached[offset:offset + length]
+        self.stream.seek(self.base + offset)
+        data = self.stream.read(length)
+        if len(data) < length:
+            raise IOError
+        return data
+    
+    def unpack(self, layout, offset):
+        """Unpack a struct at the given offset in the current byte order."""
+        layout = self.endian + layout
+        return unpack(layout, self.read(offset, calcsize(layout)))
+    
+    def ifd(self, offset):
+        """Read an IFD, returning a dict of it's entries by tag number.
+        
+        Each entry is the field type, the count and the raw four bytes that
+        hold either the value or the offset to it. The offset to the next IFD
+        is stored under the key None.
+        """
+        count = self.unpack('H', offset)[0]
+        data = self.read(offset + 2, count * 12 + 4)
+        entries = {}
+        for position in range(0, count * 12, 12):
+            tag, kind, number = unpack_from(self.endian + 'HHI', data,
+                                            position)
+            entries[tag] = (kind, number, data[position + 8:position + 12])
+        entries[None] = unpack_from(self.endian + 'I', data, count * 12)[0]
+        return entries
+    
+    def raw(self, entry):
+        """Read the bytes of an IFD entry's value, whatever it's type."""
+        kind, number, inline = entry
+        size = calcsize(self.endian + TYPES.get(kind, 'B')) * number
+        if size > 4:
+            return self.read(unpack(self.endian + 'I', inline)[0], size)
+        return inline[:size]
+    
+    def value(self, entry):
+        """Decode an IFD entry, rationals become Fractions."""
+        kind, number = entry[:2]
+        data = self.raw(entry)
+        code = TYPES.get(kind)
+        if code is None:
+            return data.split('\x00')[0] if kind == 2 else data
+        values = unpack(self.endian + code * number, data)
+        if kind in (5, 10):
+            return [Fraction(values[i], values[i + 1])
+                    for i in range(0, len(values), 2)]
+        return list(values)
+    
+    def offset(self, entry):
+        """Follow an IFD pointer, these are always the first value."""
+        return self.value(entry)[0]
+    
+    def address(self, offset, tag):
+        """Find where in the file the value of a tag in an IFD is stored."""
+        count = self.unpack('H', offset)[0]
+        for position in range(offset + 2, offset + 2 + count * 12, 12):
+            if self.unpack('H', position)[0] == tag:
+                kind, number = self.unpack('HI', position + 2)
+                if calcsize(self.endian + TYPES.get(kind, 'B')) * number > 4:
+                    return self.base + self.unpack('I', position + 8)[0]
+                return self.base + position + 8
+        raise IOError
+    
+    def encode(self, entry, value):
+        """Pack a new value for an IFD entry, which must be the same size."""
+        kind, number = entry[:2]
+        if kind == 2:
+            data = value + '\x00'
+        elif kind == 1:
+            data = chr(int(value))
+        elif kind == 5:
+            values = value if type(value) is list else [value]
+            data = ''.join([pack(self.endian + 'II', rational.numerator,
+                                 rational.denominator)
+                            for rational in values])
+        else:
+            raise IOError
+        if len(data) != calcsize(self.endian + TYPES.get(kind, 'B')) * number:
+            raise IOError
+        return data
+
+
+def empty():
+    """Create the dict of metadata that the readers below fill in."""
+    return dict(original=None, latitude=None, longitude=None, altitude=None,
+                camera={}, geonames={}, previews=[])
+
+def read_header(filename):
+    """Read the metadata of a JPEG or TIFF based file.
+    
+    Returns the same dict as photos.read_metadata, plus a list of the
+    (offset, length) of each embedded JPEG preview. Raises IOError if the
+    file is in some other format or is corrupt.
+    """
+    with open(filename, 'rb') as image:
+        magic = image.read(4)
+        try:
+            if magic.startswith('\xff\xd8'):
+                return read_jpeg(image)
+            if magic in TIFF_MAGIC:
+                image.seek(0)
+                data = empty()
+                read_tiff(TIFFReader(image, 0, image.read(HEADER_SIZE)), data)
+                return data
+        except (StructError, TypeError, ValueError, IndexError,
+                ZeroDivisionError):
+            raise IOError
+    raise IOError
+
+def read_jpeg(image):
+    """Read the APP1 and APP13 segments, stopping at the image data."""
+    data = empty()
+    for position, marker, segment in jpeg_segments(image):
+        if marker == '\xe1' and segment.startswith('Exif\x00\x00'):
+            read_tiff(TIFFReader(image, position + 10, segment[6:]), data)
+        elif marker == '\xed' and segment.startswith('Photoshop 3.0\x00'):
+            read_photoshop(segment[14:], data)
+    return data
+
+def jpeg_segments(image):
+    """Yield the position, marker and contents of the APP1 and APP13 segments.
+    
+    The other segments are skipped over without being read, and iteration
+    stops at the start of the image data.
+    """
+    position = 2
+    while True:
+        image.seek(position)
+        marker = image.read(4)
+        if len(marker) < 4 or marker[0] != '\xff':
+            raise IOError
+        if marker[1] == '\xff':
+            position += 1
+            continue
+        if marker[1] in '\xda\xd9':
+            return
+        length = unpack('>H', marker[2:])[0]
+        if marker[1] in '\xe1\xed':
+            yield position, marker[1], image.read(length - 2)
+        position += 2 + length
+
+def read_tiff(reader, data):
+    """Pull the tags we care about out of a TIFF structure."""
+    ifd0 = reader.ifd(reader.unpack('I', 4)[0])
+    ifds = {0: ifd0}
+    for pointer in (EXIF_IFD, GPS_IFD):
+        if pointer in ifd0:
+            ifds[pointer] = reader.ifd(reader.offset(ifd0[pointer]))
+    
+    for (ifd, tag), name in CAMERA.items():
+        if tag in ifds.get(ifd, {}):
+            data['camera'][name] = reader.value(ifds[ifd][tag])
+    
+    exif = ifds.get(EXIF_IFD, {})
+    if DATE_TIME_ORIGINAL in exif:
+        try:
+            data['original'] = tuple(strptime(
+                reader.value(exif[DATE_TIME_ORIGINAL]), '%Y:%m:%d %H:%M:%S'))
+        except ValueError:
+            pass
+    
+    gps = ifds.get(GPS_IFD, {})
+    if LATITUDE in gps and LATITUDE_REF in gps and \
+       LONGITUDE in gps and LONGITUDE_REF in gps:
+        data['latitude'] = dms_to_decimal(*reader.value(gps[LATITUDE]) +
+            [reader.value(gps[LATITUDE_REF]) or ' '])
+        data['longitude'] = dms_to_decimal(*reader.value(gps[LONGITUDE]) +
+            [reader.value(gps[LONGITUDE_REF]) or ' '])
+    if ALTITUDE in gps:
+        data['altitude'] = float(reader.value(gps[ALTITUDE])[0])
+        if ALTITUDE_REF in gps and reader.raw(gps[ALTITUDE_REF]) == '\x01':
+            data['altitude'] *= -1
+    
+    if IPTC_NAA in ifd0:
+        read_iptc(reader.raw(ifd0[IPTC_NAA]), data)
+    elif PHOTOSHOP in ifd0:
+        read_photoshop(reader.raw(ifd0[PHOTOSHOP]), data)
+    
+    # Previews are found in IFD1, and in the IFD0 and SubIFDs of RAW files.
+    previews = [ifd0]
+    if ifd0[None]:
+        previews.append(reader.ifd(ifd0[None]))
+    if SUB_IFDS in ifd0:
+        previews.extend([reader.ifd(offset)
+                         for offset in reader.value(ifd0[SUB_IFDS])])
+    for ifd in previews:
+        if PREVIEW_OFFSET in ifd and PREVIEW_LENGTH in ifd:
+            data['previews'].append((
+                reader.base + reader.offset(ifd[PREVIEW_OFFSET]),
+                reader.offset(ifd[PREVIEW_LENGTH])))
+        elif jpeg_strip(reader, ifd):
+            data['previews'].append((
+                reader.base + reader.offset(ifd[STRIP_OFFSETS]),
+                reader.offset(ifd[STRIP_BYTE_COUNTS])))
+
+def jpeg_strip(reader, ifd):
+    """Check whether an IFD's image is a preview stored as one JPEG strip."""
+    if COMPRESSION not in ifd or STRIP_OFFSETS not in ifd or \
+       STRIP_BYTE_COUNTS not in ifd or ifd[STRIP_OFFSETS][1] != 1:
+        return False
+    compression = reader.offset(ifd[COMPRESSION])
+    if compression == OLD_JPEG:
+        return True
+    return compression == JPEG and NEW_SUBFILE_TYPE in ifd and \
+        reader.offset(ifd[NEW_SUBFILE_TYPE]) == REDUCED_RESOLUTION
+
+def read_photoshop(irb, data):
+    """Find the IPTC data in a block of Photoshop image resources."""
+    position = 0
+    while irb.startswith('8BIM', position):
+        resource = unpack_from('>H', irb, position + 4)[0]
+        position += 6
+        position += (ord(irb[position]) + 2) & ~1
+        size = unpack_from('>I', irb, position)[0]
+        position += 4
+        if resource == 0x0404:
+            read_iptc(irb[position:position + size], data)
+            return
+        position += (size + 1) & ~1
+
+def read_iptc(iim, data):
+    """Read place names out of IPTC IIM datasets."""
+    position = 0
+    while position + 5 <= len(iim) and iim[position] == '\x1c':
+        record, dataset, size = unpack_from('>BBH', iim, position + 1)
+        if size & 0x8000:
+            break
+        position += 5
+        if record == 2 and dataset in IPTC:
+            data['geonames'].setdefault(IPTC[dataset], []).append(
+                iim[position:position + size])
+        position += size
+
+def jpeg_dimensions(jpeg):
+    """Find the width and height of a JPEG image from it's SOF marker."""
+    position = 2
+    while position + 9 <= len(jpeg) and jpeg[position] == '\xff':
+        marker = ord(jpeg[position + 1])
+        if marker == 0xFF:
+            position += 1
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = unpack_from('>HH', jpeg, position + 5)
+            return width, height
+        position += 2 + unpack_from('>H', jpeg, position + 2)[0]
+    return 0, 0
+
+def patch_header(filename, gps, geonames):
+    """Overwrite the GPS tags of a JPEG or TIFF based file in place.
+    
+    gps maps GPS tag names to their new values, and geonames maps IPTC names
+    to theirs, as pyexiv2 would be given them. Raises IOError without having
+    written anything unless every tag already exists with room for it's new
+    value and no IPTC names have changed, since those can't be patched.
+    Returns whether anything needed to be written.
+    """
+    current = read_header(filename)['geonames']
+    for name, values in geonames.items():
+        if [value.encode('utf-8') if type(value) is unicode else value
+            for value in values] != current.get(name):
+            raise IOError
+    with open(filename, 'r+b') as image:
+        try:
+            patches = gps_patches(image, gps)
+        except (StructError, TypeError, ValueError, IndexError,
+                AttributeError):
+            raise IOError
+        for position, data in patches:
+            image.seek(position)
+            image.write(data)
+        if patches:
+            image.flush()
+            fsync(image.fileno())
+    return bool(patches)
+
+def gps_patches(image, gps):
+    """List the (position, data) writes that would set the given GPS tags.
+    
+    Raises IOError if any of them would write outside of the Exif segment of
+    a JPEG, or past the end of a TIFF, as only a corrupt file points there.
+    """
+    magic = image.read(4)
+    if magic.startswith('\xff\xd8'):
+        for position, marker, segment in jpeg_segments(image):
+            if marker == '\xe1' and segment.startswith('Exif\x00\x00'):
+                reader = TIFFReader(image, position + 10, segment[6:])
+                end = position + 4 + len(segment)
+                break
+        else:
+            raise IOError
+    elif magic in TIFF_MAGIC:
+        image.seek(0)
+        reader = TIFFReader(image, 0, image.read(HEADER_SIZE))
+        end = fstat(image.fileno()).st_size
+    else:
+        raise IOError
+    ifd0 = reader.ifd(reader.unpack('I', 4)[0])
+    if GPS_IFD not in ifd0:
+        raise IOError
+    offset = reader.offset(ifd0[GPS_IFD])
+    entries = reader.ifd(offset)
+    patches = []
+    for name, value in gps.items():
+        tag = GPS.get(name)
+        if tag not in entries:
+            raise IOError
+        data = reader.encode(entries[tag], value)
+        if data != reader.raw(entries[tag]):
+            address = reader.address(offset, tag)
+            if not reader.base <= address <= end - len(data):
+                raise IOError
+            patches.append((address, data))
+    return patches
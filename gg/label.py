@@ -20,25 +20,58 @@ from __future__ import division
 from gi.repository import Gtk, Champlain, Clutter
 from os.path import basename
 
-from common import get_obj, map_view, selected, modified, photos
+from common import get_obj, map_view, selected, modified, photos, PATH
+
+class expected:
+    """The selection changes that this program is making itself.
+    
+    GTK doesn't say which rows a 'changed' signal is about, so changes that
+    are known in advance are recorded here, mapping photos to whether they're
+    being selected. None means that the change is unknown, such as a click in
+    the photo list, and every selected row has to be compared instead.
+    """
+    changes = None
+
+def known_change(changes, action, *args):
+    """Change the selection with action, which changes only the given photos."""
+    expected.changes = changes
+    try:
+        action(*args)
+    finally:
+        expected.changes = None
+
+def refresh(selection):
+    """React to photos changing while the selection itself stays the same."""
+    known_change({}, selection.emit, 'changed')
 
 def update_highlights(selection):
-    """Ensure only the selected labels are highlighted."""
-    selection_exists = selection.count_selected_rows() > 0
-    selected.clear()
-    for photo in photos.values():
-        # Maintain the 'selected' set() for easier iterating later.
-        if selection.iter_is_selected(photo.iter):
-            selected.add(photo)
-        photo.set_label_highlight(photo in selected, selection_exists)
+    """Ensure only the selected labels are highlighted.
+    
+    Only the labels of photos that were selected or deselected are restyled,
+    unless the selection became empty or stopped being empty, which changes
+    the transparency of every label.
+    """
+    if selection.get_tree_view().get_model() is None:
+        return # The liststore is detached while loading many photos.
+    if expected.changes is None:
+        model, paths = selection.get_selected_rows()
+        changed = set(photos[model[path][PATH]] for path in paths) ^ selected
+    else:
+        changed = set(photo for photo in expected.changes
+            if selection.iter_is_selected(photo.iter) != (photo in selected))
+    emptied = bool(selected) != bool(selected ^ changed)
+    # Maintain the 'selected' set() for easier iterating later.
+    selected.symmetric_difference_update(changed)
+    for photo in photos.values() if emptied else changed:
+        photo.set_label_highlight(photo in selected, len(selected) > 0)
 
 def selection_sensitivity(selection, aply, close, save, revert):
     """Control the sensitivity of various widgets."""
-    sensitive = selection.count_selected_rows() > 0
+    sensitive = len(selected) > 0
     close.set_sensitive(sensitive)
     aply.set_sensitive(sensitive)
     save.set_sensitive(  len(modified) > 0)
-    revert.set_sensitive(len(modified & selected) > 0)
+    revert.set_sensitive(not modified.isdisjoint(selected))
 
 def clicked(label, event, selection, select_all):
     """When a ChamplainLabel is clicked, select it in the GtkListStore.
@@ -50,19 +83,20 @@ def clicked(label, event, selection, select_all):
     photo = photos[label.get_name()]
     assert photo.filename == label.get_name()
     if event.get_state() & Clutter.ModifierType.CONTROL_MASK:
-        if label.get_selected(): selection.unselect_iter(photo.iter)
-        else:                    selection.select_iter(photo.iter)
+        chosen = not label.get_selected()
+        known_change({photo: chosen}, selection.select_iter if chosen
+                     else selection.unselect_iter, photo.iter)
     else:
         select_all.set_active(False)
-        selection.unselect_all()
-        selection.select_iter(photo.iter)
+        known_change(dict.fromkeys(selected, False), selection.unselect_all)
+        known_change({photo: True}, selection.select_iter, photo.iter)
 
 def drag_finish(label, event, selection):
     """Update photos with new locations after photos have been dragged."""
     photo = photos[label.get_name()]
     photo.set_location(label.get_latitude(), label.get_longitude())
     photo.manual = True
-    selection.emit('changed')
+    refresh(selection)
     map_view.emit('animation-completed')
 
 def hover(label, event, factor):
@@ -80,10 +114,24 @@ class LabelController():
         self.layer = Champlain.MarkerLayer()
         map_view.add_layer(self.layer)
         
-        self.selection.connect('changed', update_highlights)
-        self.selection.connect('changed', selection_sensitivity,
-            *[get_obj(name) for name in ('apply_button', 'close_button',
-                'save_button', 'revert_button')])
+        self.handlers = [
+            self.selection.connect('changed', update_highlights),
+            self.selection.connect('changed', selection_sensitivity,
+                *[get_obj(name) for name in ('apply_button', 'close_button',
+                    'save_button', 'revert_button')])
+        ]
+    
+    def select(self, chosen):
+        """Select many photos, reacting to the selection changing only once."""
+        for handler in self.handlers:
+            self.selection.handler_block(handler)
+        try:
+            for photo in chosen:
+                self.selection.select_iter(photo.iter)
+        finally:
+            for handler in self.handlers:
+                self.selection.handler_unblock(handler)
+        known_change(dict.fromkeys(chosen, True), self.selection.emit, 'changed')
     
     def add(self, name):
         """Create a new ChamplainLabel and add it to the map."""
@@ -93,6 +141,7 @@ class LabelController():
         label.set_selectable(True)
         label.set_draggable(True)
         label.set_property('reactive', True)
+        label.set_opacity(64 if selected else 255)
         label.connect('enter-event', hover, 1.05)
         label.connect('leave-event', hover, 1/1.05)
         label.connect('drag-finish', drag_finish, self.selection)
@@ -18,12 +18,22 @@
 from __future__ import division
 
 from gi.repository import Gio, GObject, GdkPixbuf
-from pyexiv2 import ImageMetadata
-from time import mktime
-from os import stat
+from pyexiv2 import ImageMetadata, XmpTag
+from multiprocessing import Pool, TimeoutError, cpu_count
+from itertools import izip, imap
+from functools import partial
+from os import O_RDONLY, chmod, chown, close, fsync, rename, stat, unlink
+from os import open as os_open, umask
+from os.path import basename, dirname, exists, split, realpath
+from tempfile import mkstemp
+from shutil import copy2
 
-from camera import Camera
-from gpsmath import Coordinates, format_list
+import thumbnails
+from headers import read_header, patch_header, jpeg_dimensions
+from sidecar import TEMPLATE, find_sidecar, encode_xmp, decode_xmp
+from timestamps import clock, naive_seconds
+from camera import get_camera, KEYS as CAMERA_KEYS
+from gpsmath import BaseCoordinates, format_list
 from gpsmath import dms_to_decimal, decimal_to_dms, float_to_rational
 from territories import get_state, get_country
 
@@ -31,97 +41,573 @@ from territories import get_state, get_country
 GPS  = 'Exif.GPSInfo.GPS'
 IPTC = 'Iptc.Application2.'
 
+# The IPTC keys that hold the names of the place where a photo was taken.
+GEONAMES = ('City', 'ProvinceState', 'CountryName', 'CountryCode')
 
-class Photograph(Coordinates):
-    """Represents a single photograph and it's location in space and time."""
+# Starting worker processes takes longer than reading a few photos does.
+PARALLEL_MINIMUM = 32
+
+# Saving is mostly waiting on the disk, so more writers wouldn't help.
+SAVE_WORKERS = 4
+
+# Seconds to wait for a worker before letting the interface redraw.
+IDLE_INTERVAL = 0.1
+
+# Leading bytes of the image formats that exiv2 can read. Most RAW formats
+# are TIFF-based and so they start with one of the TIFF byte order marks.
+IMAGE_MAGIC = (
+    '\xff\xd8\xff',                 # JPEG
+    'II*\x00', 'MM\x00*',            # TIFF, DNG, NEF, CR2, PEF, ARW, etc
+    'IIRO', 'IIRS', 'IIU\x00',        # ORF, RW2
+    'II\x1a\x00\x00\x00HEAPCCDR',     # CRW
+    'FUJIFILMCCD-RAW',               # RAF
+    '\x00MRM',                       # MRW
+    '\x89PNG', 'GIF8', '8BPS',        # PNG, GIF, PSD
+)
+
+# Leading bytes of formats that GdkPixbuf can decode at a reduced size.
+DECODABLE = ('\xff\xd8\xff', '\x89PNG', 'GIF8')
+
+# Leading bytes of TIFF files, which GdkPixbuf can decode, but only in full.
+TIFF = ('II*\x00', 'MM\x00*')
+
+# Fallback for files whose magic is ambiguous or unrecognized.
+IMAGE_EXTENSIONS = set([
+    'jpg', 'jpeg', 'jpe', 'tif', 'tiff', 'png', 'gif', 'psd', 'jp2', 'pgf',
+    'dng', 'nef', 'nrw', 'cr2', 'crw', 'pef', 'arw', 'sr2', 'srf', 'srw',
+    'orf', 'rw2', 'raf', 'mrw', 'exv',
+])
+
+
+def open_metadata(filename):
+    """Read all of the file's metadata with pyexiv2."""
+    exif = ImageMetadata(filename)
+    try:
+        exif.read()
+    except TypeError:
+        raise IOError
+    return exif
+
+def read_metadata(filename, sidecars=False):
+    """Extract just the metadata that GottenGeography needs from a file.
+    
+    Only plain Python values are returned, so that this can be called from a
+    worker process. The headers of JPEG and TIFF based files are read
+    directly, pyexiv2 is only needed for other formats. If sidecars is True,
+    values found in an XMP sidecar take precedence over those in the file,
+    otherwise sidecars are ignored, because they're only saved to when that
+    preference is on. Raises IOError if the file is not a photograph.
+    """
+    try:
+        data = read_header(filename)
+        del data['previews']
+    except IOError:
+        data = read_exif(open_metadata(filename))
+    sidecar = find_sidecar(filename) if sidecars else None
+    if sidecar is not None:
+        try:
+            decode_xmp(open_metadata(sidecar), data)
+        except IOError:
+            pass
+    return data
+
+def read_exif(exif):
+    """Extract the values that read_metadata returns from pyexiv2 metadata."""
+    data = dict(original=None, latitude=None, longitude=None, altitude=None,
+                camera={}, geonames={})
+    try:
+        data['original'] = tuple(
+            exif['Exif.Photo.DateTimeOriginal'].value.timetuple())
+    except (KeyError, AttributeError):
+        pass
+    try:
+        data['latitude'] = dms_to_decimal(
+            *exif[GPS + 'Latitude'].value +
+            [exif[GPS + 'LatitudeRef'].value]
+        )
+        data['longitude'] = dms_to_decimal(
+            *exif[GPS + 'Longitude'].value +
+            [exif[GPS + 'LongitudeRef'].value]
+        )
+    except KeyError:
+        pass
+    try:
+        data['altitude'] = float(exif[GPS + 'Altitude'].value)
+        if int(exif[GPS + 'AltitudeRef'].value) > 0:
+            data['altitude'] *= -1
+    except KeyError:
+        pass
+    for key in CAMERA_KEYS:
+        try:
+            data['camera'][key.split('.')[-1]] = exif[key].value
+        except KeyError:
+            pass
+    for key in GEONAMES:
+        try:
+            data['geonames'][key] = exif[IPTC + key].values
+        except KeyError:
+            pass
+    return data
+
+def read_previews(filename):
+    """List embedded previews as (dimensions, data) pairs, smallest first."""
+    try:
+        spans = read_header(filename)['previews']
+    except IOError:
+        return exiv2_previews(filename)
+    previews = []
+    with open(filename, 'rb') as image:
+        for offset, length in spans:
+            image.seek(offset)
+            data = image.read(length)
+            if data.startswith('\xff\xd8'):
+                previews.append((jpeg_dimensions(data), data))
+    return sorted(previews)
+
+def exiv2_previews(filename):
+    """List every preview that pyexiv2 can find, smallest first.
+    
+    This is slower than reading the headers, but it also understands the
+    previews that read_header doesn't, such as tiled ones.
+    """
+    exif = open_metadata(filename)
+    previews = [(preview.dimensions, preview.data)
+                for preview in exif.previews]
+    if not previews and len(exif.exif_thumbnail.data) > 0:
+        data = exif.exif_thumbnail.data
+        previews.append((jpeg_dimensions(data), data))
+    return sorted(previews)
+
+def preview_of_size(previews, size):
+    """Find the smallest preview that is at least size, if any."""
+    for dimensions, preview in previews:
+        if max(dimensions) >= size:
+            return preview
+
+def fetch(filename, sidecars=False):
+    """Read metadata in a worker process, which can't raise IOError."""
+    try:
+        return read_metadata(filename, sidecars)
+    except IOError:
+        return None
+
+def fetch_all(filenames, sidecars=False):
+    """Read the metadata of many photos at once, using every available core.
+    
+    Yields each filename along with it's metadata, in the order given. The
+    metadata is None for files that couldn't be read.
+    """
+    if len(filenames) < PARALLEL_MINIMUM or cpu_count() < 2:
+        for filename in filenames:
+            yield filename, fetch(filename, sidecars)
+        return
+    pool = Pool()
+    try:
+        results = pool.imap(partial(fetch, sidecars=sidecars), filenames, 8)
+        for result in izip(filenames, results):
+            yield result
+    finally:
+        pool.terminate()
+
+def encode(geotags):
+    """Convert geotags into the exact tag values that would be written."""
+    filename, latitude, longitude, altitude, geonames = geotags
+    tags = {}
+    if altitude is not None:
+        tags[GPS + 'Altitude']    = float_to_rational(altitude)
+        tags[GPS + 'AltitudeRef'] = '0' if altitude >= 0 else '1'
+    if latitude is not None and longitude is not None:
+        tags[GPS + 'Latitude']     = decimal_to_dms(latitude)
+        tags[GPS + 'LatitudeRef']  = 'N' if latitude >= 0 else 'S'
+        tags[GPS + 'Longitude']    = decimal_to_dms(longitude)
+        tags[GPS + 'LongitudeRef'] = 'E' if longitude >= 0 else 'W'
+        tags[GPS + 'MapDatum']     = 'WGS-84'
+    for key, values in geonames.items():
+        tags[IPTC + key] = values
+    return tags
+
+def changed_tags(exif, tags):
+    """Find the tags whose values differ from what's in the file already."""
+    changed = {}
+    for key, value in tags.items():
+        try:
+            tag = exif[key]
+            if key.startswith(IPTC):
+                current = tag.values
+            elif key.startswith('Xmp.'):
+                current = tag.raw_value
+            else:
+                current = tag.value
+        except KeyError:
+            current = None
+        if current != value:
+            changed[key] = value
+    return changed
+
+def set_tags(filename, changed):
+    """Write new tag values into a file, and flush it to disk."""
+    exif = open_metadata(filename)
+    for key, value in changed.items():
+        if key.startswith('Xmp.'):
+            exif[key] = XmpTag(key)
+            exif[key].raw_value = value
+        else:
+            exif[key] = value
+    exif.write()
+    with open(filename, 'rb') as written:
+        fsync(written.fileno())
+
+def keep_owner(temp, info):
+    """Give a copy the owner and group of the original, if allowed to."""
+    if (stat(temp).st_uid, stat(temp).st_gid) == (info.st_uid, info.st_gid):
+        return True
+    try:
+        chown(temp, info.st_uid, info.st_gid)
+    except OSError:
+        return False
+    return True
+
+def default_mode():
+    """Find the mode that new files get, according to the umask."""
+    mask = umask(0)
+    umask(mask)
+    return 0666 & ~mask
+
+def replace_tags(filename, changed, template=None):
+    """Atomically replace a file with a copy of it that has new tag values.
+    
+    The tags are written into a copy of the file, which is flushed to disk
+    and then renamed over the original, so a failure never leaves a file half
+    written. Symlinks are followed, so that it's their target that's
+    replaced. Files with other hard links, or whose owner can't be given to
+    the copy, are written in place instead, so that they stay the same file.
+    If a template is given, the file is created from that instead. Syncing
+    the directory is left to the caller, so that it can be done once for
+    many files.
+    """
+    filename = realpath(filename)
+    if template is None:
+        info = stat(filename)
+        if info.st_nlink > 1:
+            set_tags(filename, changed)
+            return
+    directory, name = split(filename)
+    handle, temp = mkstemp('', '.%s.' % name, directory)
+    close(handle)
+    try:
+        if template is None:
+            copy2(filename, temp)
+            if not keep_owner(temp, info):
+                set_tags(filename, changed)
+                return
+        else:
+            with open(temp, 'wb') as new:
+                new.write(template)
+            chmod(temp, default_mode())
+        set_tags(temp, changed)
+        rename(temp, filename)
+    finally:
+        if exists(temp):
+            unlink(temp)
+
+def write_metadata(geotags):
+    """Write geotags into a file, returning the name of the file written.
+    
+    geotags is what Photograph.geotags returned. Only tags that differ from
+    the file are written, and if none do, the file isn't touched at all and
+    None is returned. When the file already has room for the new GPS tags,
+    just those bytes are overwritten, otherwise the whole file is replaced.
+    """
+    filename = geotags[0]
+    tags = encode(geotags)
+    gps = dict([(key[len(GPS):], value) for key, value in tags.items()
+                if key.startswith(GPS)])
+    iptc = dict([(key[len(IPTC):], value) for key, value in tags.items()
+                 if key.startswith(IPTC)])
+    try:
+        return filename if patch_header(filename, gps, iptc) else None
+    except IOError:
+        pass
+    changed = changed_tags(open_metadata(filename), tags)
+    if not changed:
+        return None
+    replace_tags(filename, changed)
+    return filename
+
+def write_sidecar(geotags):
+    """Write geotags into an XMP sidecar, leaving the photo itself alone.
+    
+    An existing sidecar is updated, otherwise one is created that's named
+    after the photo. Returns the name of the sidecar, or None if it already
+    held these geotags.
+    """
+    sidecar = find_sidecar(geotags[0])
+    if sidecar is None:
+        sidecar = geotags[0] + '.xmp'
+        replace_tags(sidecar, encode_xmp(geotags), TEMPLATE)
+        return sidecar
+    changed = changed_tags(open_metadata(sidecar), encode_xmp(geotags))
+    if not changed:
+        return None
+    replace_tags(sidecar, changed)
+    return sidecar
+
+def sync_directory(directory):
+    """Make sure that renames within the directory have reached the disk."""
+    handle = os_open(directory, O_RDONLY)
+    try:
+        fsync(handle)
+    finally:
+        close(handle)
+
+def save(job):
+    """Write geotags in a worker process, returning any error as a string.
+    
+    job is a geotags tuple and whether to write them to a sidecar. Also
+    returned are the name of the file that was written, or None if nothing
+    needed to be, and the mtime of the photo from before it was written.
+    """
+    geotags, sidecar = job
+    try:
+        mtime = stat(geotags[0]).st_mtime
+        written = (write_sidecar if sidecar else write_metadata)(geotags)
+    except Exception as inst:
+        return (geotags[0], None, None,
+                '%s: %s' % (basename(geotags[0]), inst))
+    return geotags[0], written, mtime, None
+
+def waiting(results, idle):
+    """Iterate over results from a pool, calling idle while waiting."""
+    while True:
+        try:
+            yield results.next(IDLE_INTERVAL)
+        except TimeoutError:
+            idle()
+        except StopIteration:
+            return
+
+def save_all(jobs, idle, sidecars=False):
+    """Write many files at once with a small pool of worker processes.
+    
+    jobs is a list of geotags tuples. Yields (filename, error) as each file
+    is finished, in no particular order, where error is None on success.
+    idle is called regularly while waiting on the workers. Directories are
+    synced once all of the files in them have been written. If sidecars is
+    True, the geotags go into XMP sidecars instead of the photos.
+    """
+    directories = set()
+    jobs = [(geotags, sidecars) for geotags in jobs]
+    if len(jobs) < PARALLEL_MINIMUM or cpu_count() < 2:
+        pool, results = None, imap(save, jobs)
+    else:
+        pool = Pool(min(cpu_count(), SAVE_WORKERS))
+        results = waiting(pool.imap_unordered(save, jobs), idle)
+    try:
+        for filename, written, mtime, error in results:
+            if written is not None:
+                directories.add(dirname(realpath(written)))
+            if written == filename:
+                thumbnails.restamp(filename, mtime)
+            yield filename, error
+    finally:
+        if pool is not None:
+            pool.terminate()
+        for directory in directories:
+            sync_directory(directory)
+
+
+class Photograph(BaseCoordinates):
+    """Represents a single photograph and it's location in space and time.
+    
+    Only the few values that are displayed or saved are kept, and __slots__
+    avoids the cost of a __dict__ for each photo, because there may be tens
+    of thousands of them loaded at once.
+    """
+    
+    __slots__ = ('filename', 'callback', 'thm_size', 'label', 'iter',
+                 'original', 'geonames', 'thumb', 'manual', 'timestamp',
+                 'altitude', 'latitude', 'longitude', 'timezone', 'saved',
+                 'snapshot', 'camera', 'summary', 'geotagged')
     
     def __init__(self, filename, callback, thumb_size=200):
         """Initialize new Photograph object's attributes with default values."""
-        self.filename = filename
-        self.callback = callback
-        self.thm_size = thumb_size
-        self.label    = None
-        self.iter     = None
-        self.exif     = None
-        self.thumb    = None
-        self.manual   = None
-    
-    def read(self):
-        """Load exif data from disk."""
-        self.exif      = ImageMetadata(self.filename)
+        self.filename  = filename
+        self.callback  = callback
+        self.thm_size  = thumb_size
+        self.label     = None
+        self.iter      = None
+        self.original  = None
+        self.geonames  = {}
+        self.thumb     = None
+        self.manual    = None
         self.timestamp = None
         self.altitude  = None
         self.latitude  = None
         self.longitude = None
         self.timezone  = None
+        self.saved     = None
+        self.snapshot  = None
+        self.camera    = None
+        self.summary   = None
+        self.geotagged = None
+    
+    def read(self, data=None, sidecars=False):
+        """Load exif data from disk, unless it has already been read.
+        
+        data is what read_metadata returned for this photo, if anything. The
+        coordinates found when the photo is first read are kept separately as
+        geotagged, because anything read later may have been saved by us.
+        """
+        if data is None:
+            data = read_metadata(self.filename, sidecars)
+        self.original  = (naive_seconds(data['original'])
+                          if data['original'] is not None else None)
+        self.geonames  = data['geonames']
+        self.altitude  = data['altitude']
+        self.latitude  = data['latitude']
+        self.longitude = data['longitude']
+        self.timezone  = None
         self.manual    = False
-        try:
-            self.exif.read()
-        except TypeError:
-            raise IOError
+        if self.snapshot is None and self.valid_coords():
+            self.geotagged = (self.latitude, self.longitude)
+        self.remember()
         
-        Camera(self.exif)
+        self.camera    = get_camera(data['camera'])
         
-        # Try to get a thumbnail.
-        try:
-            self.thumb = GdkPixbuf.Pixbuf.new_from_file_at_size(
-                    self.filename, self.thm_size, self.thm_size)
-        except GObject.GError:
-            if len(self.exif.previews) > 0:
-                data = self.exif.previews[-1].data
-            elif len(self.exif.exif_thumbnail.data) > 0:
-                data = self.exif.exif_thumbnail.data
+        self.calculate_timestamp()
+    
+    def read_thumbnail(self):
+        """Load the thumbnail from the shared cache, creating it if need be.
+        
+        New thumbnails are created at the cache's large size and stored there
+        before being scaled down, so that they can be reused at any size.
+        Thumbnails made from a preview that was too small are only kept in
+        memory, so that other applications never get them from the cache.
+        """
+        self.thumb = thumbnails.load(self.filename, self.thm_size)
+        if self.thumb is None:
+            pixbuf, complete = self.create_thumbnail(thumbnails.LARGE)
+            if complete:
+                thumbnails.save(self.filename, pixbuf)
+            self.thumb = thumbnails.scale(pixbuf, self.thm_size)
+    
+    def create_thumbnail(self, size):
+        """Create a thumbnail without decoding the full image if possible.
+        
+        The smallest embedded preview that is at least as big as the thumbnail
+        is used if there is one. Otherwise, formats that GdkPixbuf can decode
+        at a reduced size are loaded that way, which lets libjpeg scale the
+        image down during the DCT instead of decoding every pixel. Plain TIFFs
+        without any previews are decoded in full as a last resort. RAW files
+        are never decoded, pyexiv2 is asked for any previews that the headers
+        didn't reveal, and failing that the largest one is used as it is.
+        
+        Returns the thumbnail, and whether it's as complete as the image
+        allows, rather than limited by the size of a preview. Images are
+        never scaled up.
+        """
+        previews = read_previews(self.filename)
+        data = preview_of_size(previews, size)
+        
+        if data is None:
+            with open(self.filename, 'rb') as image:
+                magic = image.read(4)
+            if magic.startswith(DECODABLE) or (
+                    magic.startswith(TIFF) and len(previews) == 0):
+                try:
+                    info, width, height = GdkPixbuf.Pixbuf.get_file_info(
+                        self.filename)
+                    limit = min(size, max(width, height)) or size
+                    return GdkPixbuf.Pixbuf.new_from_file_at_size(
+                        self.filename, limit, limit), True
+                except (GObject.GError, TypeError):
+                    pass
+            try:
+                previews = sorted(previews + exiv2_previews(self.filename))
+            except IOError:
+                pass
+            data = preview_of_size(previews, size)
+        
+        complete = data is not None
+        if data is None:
+            if len(previews) > 0:
+                data = previews[-1][1]
             else:
                 raise IOError
-            
-            self.thumb = GdkPixbuf.Pixbuf.new_from_stream_at_scale(
-                Gio.MemoryInputStream.new_from_data(data, None),
-                self.thm_size, self.thm_size, True, None)
         
-        self.calculate_timestamp()
-        try:
-            self.latitude = dms_to_decimal(
-                *self.exif[GPS + 'Latitude'].value +
-                [self.exif[GPS + 'LatitudeRef'].value]
-            )
-            self.longitude = dms_to_decimal(
-                *self.exif[GPS + 'Longitude'].value +
-                [self.exif[GPS + 'LongitudeRef'].value]
-            )
-        except KeyError:
-            pass
+        stream = Gio.MemoryInputStream.new_from_data(data, None)
         try:
-            self.altitude = float(self.exif[GPS + 'Altitude'].value)
-            if int(self.exif[GPS + 'AltitudeRef'].value) > 0:
-                self.altitude *= -1
-        except KeyError:
-            pass
+            if complete:
+                return GdkPixbuf.Pixbuf.new_from_stream_at_scale(
+                    stream, size, size, True, None), True
+            return GdkPixbuf.Pixbuf.new_from_stream(stream, None), False
+        except GObject.GError:
+            raise IOError
     
-    def calculate_timestamp(self):
-        """Determine the timestamp based on the currently selected timezone.
+    def calculate_timestamp(self, zone=None):
+        """Determine the timestamp based on the given timezone.
         
-        This method relies on the TZ environment variable to be set before
-        it is called. If you don't set TZ before calling this method, then it
-        implicitely assumes that the camera and the computer are set to the
-        same timezone.
+        The timezone defaults to the one that the photo's camera is set to.
+        Photos that don't record when they were taken use their file's mtime,
+        which is unaffected by the timezone.
         """
-        try:
-            self.timestamp = int(mktime(
-                self.exif['Exif.Photo.DateTimeOriginal'].value.timetuple()))
-        except KeyError:
+        if zone is None:
+            zone = self.zone()
+        if self.original is not None:
+            self.timestamp = zone.epoch(self.original)
+        else:
             self.timestamp = int(stat(self.filename).st_mtime)
     
-    def write(self):
-        """Save exif data to photo file on disk."""
-        if self.altitude is not None:
-            self.exif[GPS + 'Altitude']    = float_to_rational(self.altitude)
-            self.exif[GPS + 'AltitudeRef'] = '0' if self.altitude >= 0 else '1'
-        self.exif[GPS + 'Latitude']     = decimal_to_dms(self.latitude)
-        self.exif[GPS + 'LatitudeRef']  = 'N' if self.latitude >= 0 else 'S'
-        self.exif[GPS + 'Longitude']    = decimal_to_dms(self.longitude)
-        self.exif[GPS + 'LongitudeRef'] = 'E' if self.longitude >= 0 else 'W'
-        self.exif[GPS + 'MapDatum']     = 'WGS-84'
-        self.exif.write()
+    def offset(self):
+        """The number of seconds that this photo's camera's clock is off by."""
+        return self.camera.offset if self.camera is not None else 0
+    
+    def geotags(self):
+        """Collect everything that write_metadata needs to save this photo."""
+        return (self.filename, self.latitude, self.longitude, self.altitude,
+                self.geonames)
+    
+    def encoded(self):
+        """The tag values that saving this photo would write."""
+        return encode(self.geotags())
+    
+    def unchanged(self):
+        """Check whether saving would write what was last read or saved."""
+        return self.encoded() == self.saved
+    
+    def forget(self):
+        """Assume nothing about what's on disk, so that saving writes it."""
+        self.saved = None
+    
+    def remember(self):
+        """Note the geotags as they are on disk, after reading or saving."""
+        self.saved = self.encoded()
+        self.snapshot = (stat(self.filename).st_mtime, self.latitude,
+                         self.longitude, self.altitude, self.geonames)
+    
+    def revert(self):
+        """Restore the geotags from when this photo was last read or saved.
+        
+        Returns False without changing anything if the file has been modified
+        by something else since then, in which case it has to be read again.
+        """
+        try:
+            if stat(self.filename).st_mtime != self.snapshot[0]:
+                return False
+        except OSError:
+            return False
+        (mtime, self.latitude, self.longitude,
+         self.altitude, self.geonames) = self.snapshot
+        self.timezone = None
+        self.manual   = False
+        return True
+    
+    def write(self, sidecar=False):
+        """Save exif data to photo file on disk, or to it's XMP sidecar."""
+        for filename, error in save_all([self.geotags()], lambda: None,
+                                        sidecar):
+            if error is not None:
+                raise IOError(error)
     
     def set_location(self, lat, lon, ele=None):
         """Alter the coordinates of this photo."""
@@ -144,29 +630,54 @@ class Photograph(Coordinates):
             self.label.hide()
     
     def set_label_highlight(self, highlight, transparent):
-        """Set the highlightedness of the given photo's ChamplainLabel."""
-        if self.label.get_property('visible'):
-            self.label.set_scale(*[1.1 if highlight else 1] * 2)
-            self.label.set_selected(highlight)
-            self.label.set_opacity(64 if transparent and not highlight else 255)
-            if highlight:
-                self.label.raise_top()
+        """Set the highlightedness of the given photo's ChamplainLabel.
+        
+        Hidden labels are styled too, because they're only restyled when
+        their selection changes, and position_label may show them later.
+        """
+        self.label.set_scale(*[1.1 if highlight else 1] * 2)
+        self.label.set_selected(highlight)
+        self.label.set_opacity(64 if transparent and not highlight else 255)
+        if highlight and self.label.get_property('visible'):
+            self.label.raise_top()
     
     def set_geodata(self, data):
-        """Override Coordinates.set_geodata to apply directly into IPTC."""
-        city, state, country, tz          = data
-        self.exif[IPTC + 'City']          = [city or '']
-        self.exif[IPTC + 'ProvinceState'] = [get_state(country, state) or '']
-        self.exif[IPTC + 'CountryName']   = [get_country(country) or '']
-        self.exif[IPTC + 'CountryCode']   = [country or '']
-        self.timezone                     = tz.strip()
+        """Override BaseCoordinates.set_geodata to keep IPTC names instead."""
+        city, state, country, tz = data
+        self.geonames = {
+            'City':          [city or ''],
+            'ProvinceState': [get_state(country, state) or ''],
+            'CountryName':   [get_country(country) or ''],
+            'CountryCode':   [country or ''],
+        }
+        self.timezone = tz.strip()
+    
+    def long_summary(self):
+        """Memoize BaseCoordinates.long_summary until anything in it changes.
+        
+        The geonames are replaced, never modified, whenever they change, so
+        comparing them is usually just an identity check.
+        """
+        inputs = (self.timestamp, self.latitude, self.longitude,
+                  self.altitude, self.geonames, self.zone())
+        if self.summary is None or self.summary[0] != inputs:
+            self.summary = (inputs, BaseCoordinates.long_summary(self))
+        return self.summary[1]
+    
+    def zone(self):
+        """The timezone that this photo's camera is set to."""
+        return self.camera.timezone() if self.camera is not None else clock.zone
+    
+    def pretty_time(self):
+        """Override BaseCoordinates.pretty_time to use the camera's timezone."""
+        if type(self.timestamp) is int:
+            return self.zone().format(self.timestamp)
     
     def pretty_geoname(self):
-        """Override Coordinates.pretty_geoname to read from IPTC."""
+        """Override BaseCoordinates.pretty_geoname to read from IPTC."""
         names = []
         for key in [ 'City', 'ProvinceState', 'CountryName' ]:
-            try: names.extend(self.exif[IPTC + key].values)
-            except KeyError: pass
+            names.extend(self.geonames.get(key, []))
         length = sum(map(len, names))
         return format_list(names, ',\n' if length > 35 else ', ')
 
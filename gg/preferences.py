@@ -20,12 +20,12 @@ from __future__ import division
 from gi.repository import Gtk, Gdk
 from gi.repository import Champlain
 from gi.repository import Clutter
-from time import tzset
-from os import environ
 
 from common import Struct, polygons, photos, map_view
-from common import auto_timestamp_comparison, get_obj, gst
+from common import auto_timestamp_comparison, calculate_timestamps
+from common import get_obj, gst
 from territories import tz_regions, get_timezone
+from timestamps import clock, get_zone
 
 def make_clutter_color(color):
     """Generate a Clutter.Color from the currently chosen color."""
@@ -134,6 +134,7 @@ class PreferencesController():
         
         gst.bind('use-dark-theme', Gtk.Settings.get_default(),
                  'gtk-application-prefer-dark-theme')
+        gst.bind('xmp-sidecars', get_obj('xmp-sidecars'), 'active')
         
         map_source_menu()
     
@@ -145,7 +146,8 @@ class PreferencesController():
             'custom': gst.get_boolean('custom-timezone'),
             'region': region.get_active(),
             'city':   cities.get_active(),
-            'color':  colorpicker.get_current_color()
+            'color':  colorpicker.get_current_color(),
+            'xmp':    gst.get_boolean('xmp-sidecars')
         })
         if not dialog.run():
             colorpicker.set_current_color(previous.color)
@@ -155,22 +157,25 @@ class PreferencesController():
             gst.set_boolean('custom-timezone', previous.custom)
             region.set_active(previous.region)
             cities.set_active(previous.city)
+            gst.set_boolean('xmp-sidecars', previous.xmp)
         dialog.hide()
     
     def set_timezone(self):
         """Set the timezone to the given zone and update all photos."""
-        if 'TZ' in environ:
-            del environ['TZ']
+        name = None
         if gst.get_boolean('lookup-timezone'):
-            environ['TZ'] = self.gpx_timezone
+            name = self.gpx_timezone
         elif gst.get_boolean('custom-timezone'):
             region = self.region.get_active_id()
             city   = self.cities.get_active_id()
             if region is not None and city is not None:
-                environ['TZ'] = '%s/%s' % (region, city)
-        tzset()
+                name = '%s/%s' % (region, city)
+        clock.zone = get_zone(name)
+        clock.lookup = None
+        if self.gpx_timezone:
+            clock.lookup = get_zone(self.gpx_timezone)
+        calculate_timestamps()
         for photo in photos.values():
-            photo.calculate_timestamp()
             auto_timestamp_comparison(photo)
     
     def radio_handler(self, radio):
@@ -0,0 +1,115 @@
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Translate geotags to and from the tags used in XMP sidecar files.
+
+Sidecars let geotags be saved without rewriting the photo itself, which for
+large RAW files is most of the cost of saving. They're named after the whole
+filename of the photo, eg IMG_1234.CR2.xmp, so that a RAW and a JPEG with the
+same base name don't share one, but sidecars named after just the base name,
+eg IMG_1234.xmp, are also found when reading.
+
+Values are exchanged as raw XMP strings, which pyexiv2 passes through as-is.
+"""
+
+from __future__ import division
+
+from os.path import exists, splitext
+from fractions import Fraction
+
+from gpsmath import dms_to_decimal, float_to_rational
+
+# Contents of a new sidecar, before pyexiv2 fills in the tags.
+TEMPLATE = """<?xpacket begin="\xef\xbb\xbf" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>
+"""
+
+XMP = 'Xmp.exif.GPS'
+
+# XMP equivalents of the IPTC place names.
+GEONAMES = {
+    'City':          'Xmp.photoshop.City',
+    'ProvinceState': 'Xmp.photoshop.State',
+    'CountryName':   'Xmp.photoshop.Country',
+    'CountryCode':   'Xmp.iptc.CountryCode',
+}
+
+
+def sidecar_names(filename):
+    """List the names that the sidecar for filename might have."""
+    base = splitext(filename)[0]
+    return [filename + '.xmp', filename + '.XMP', base + '.xmp', base + '.XMP']
+
+def find_sidecar(filename):
+    """Return the name of the existing sidecar for filename, if any."""
+    for name in sidecar_names(filename):
+        if exists(name):
+            return name
+
+def encode_coordinate(decimal, directions):
+    """Format decimal degrees as an XMP GPSCoordinate, eg '53,32.50000N'."""
+    minutes = abs(decimal) * 60
+    return '%d,%.5f%s' % (minutes // 60, minutes % 60,
+                          directions[0 if decimal >= 0 else 1])
+
+def decode_coordinate(raw):
+    """Convert an XMP GPSCoordinate into decimal degrees."""
+    parts = [float(part) for part in raw[:-1].split(',')]
+    return dms_to_decimal(*(parts + [0, 0])[:3] + [raw[-1]])
+
+def encode_xmp(geotags):
+    """Convert geotags into the raw XMP values that would be written."""
+    filename, latitude, longitude, altitude, geonames = geotags
+    tags = {}
+    if altitude is not None:
+        rational = float_to_rational(altitude)
+        tags[XMP + 'Altitude'] = '%d/%d' % (rational.numerator,
+                                            rational.denominator)
+        tags[XMP + 'AltitudeRef'] = '0' if altitude >= 0 else '1'
+    if latitude is not None and longitude is not None:
+        tags[XMP + 'Latitude']  = encode_coordinate(latitude, 'NS')
+        tags[XMP + 'Longitude'] = encode_coordinate(longitude, 'EW')
+        tags[XMP + 'MapDatum']  = 'WGS-84'
+    for key, values in geonames.items():
+        if key in GEONAMES:
+            tags[GEONAMES[key]] = ', '.join(values)
+    return tags
+
+def decode_xmp(xmp, data):
+    """Override the values in data with those found in a sidecar."""
+    def raw(key):
+        return xmp[key].raw_value
+    try:
+        data['latitude'], data['longitude'] = (
+            decode_coordinate(raw(XMP + 'Latitude')),
+            decode_coordinate(raw(XMP + 'Longitude')))
+    except (KeyError, ValueError, IndexError):
+        pass
+    try:
+        altitude = float(Fraction(raw(XMP + 'Altitude')))
+        if xmp.get(XMP + 'AltitudeRef') and raw(XMP + 'AltitudeRef') == '1':
+            altitude *= -1
+        data['altitude'] = altitude
+    except (KeyError, ValueError, ZeroDivisionError):
+        pass
+    for name, key in GEONAMES.items():
+        try:
+            data['geonames'][name] = [raw(key)]
+        except KeyError:
+            pass
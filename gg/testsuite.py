@@ -17,23 +17,37 @@
 
 from __future__ import division
 
-from gi.repository import Gdk, Clutter, Champlain
+from gi.repository import GLib, Gdk, GdkPixbuf, Clutter, Champlain
 from unittest import TestCase, TextTestRunner, TestLoader
-from os import listdir, system, environ
-from os.path import join, abspath
+from os import listdir, system, environ, stat, utime, umask, symlink, link
+from os.path import join, abspath, islink, exists
+from tempfile import mkstemp, mkdtemp
+from gzip import GzipFile
+from operator import xor
+from struct import pack
 from fractions import Fraction
 from random import random
 from math import floor
+from hashlib import md5
 from time import tzset
 
 import app
-from photos import Photograph
+import thumbnails
+from photos import Photograph, fetch, fetch_all, PARALLEL_MINIMUM
+from photos import save_all, encode, write_metadata, read_previews, GPS
+from headers import read_header, patch_header, jpeg_dimensions
+from headers import jpeg_segments, TIFFReader, GPS_IFD
+from sidecar import find_sidecar, encode_coordinate, decode_coordinate
+from camera import get_camera, cameras
+from timestamps import clock, get_zone, naive_seconds
+from territories import tz_regions, get_timezone
 from gpsmath import Coordinates, valid_coords
 from gpsmath import decimal_to_dms, dms_to_decimal, float_to_rational
 from preferences import MAP_SOURCES, make_clutter_color
 from common import Struct, Polygon, polygons, map_view
-from common import points, photos, selected, modified
+from common import points, photos, selected, modified, trackfiles
 from navigation import move_by_arrow_keys
+from label import known_change, refresh
 from build_info import PKG_DATA_DIR
 
 gui = app.GottenGeography()
@@ -147,6 +161,133 @@ class GottenGeographyTester(TestCase):
                 self.assertEqual(other.label.get_scale(), (1, 1))
                 self.assertFalse(other.label.get_selected())
                 self.assertEqual(other.label.get_property('opacity'), 64)
+        
+        # Extending the selection restyles the new label, even while hidden.
+        first, second = photos.values()[:2]
+        second.label.hide()
+        gui.labels.selection.unselect_all()
+        gui.labels.selection.select_iter(first.iter)
+        gui.labels.selection.select_iter(second.iter)
+        self.assertEqual(selected, set([first, second]))
+        self.assertTrue(second.label.get_selected())
+        self.assertEqual(second.label.get_scale(), (1.1, 1.1))
+        self.assertFalse(get_obj('revert_button').get_sensitive())
+        modified.add(first)
+        gui.labels.selection.emit('changed')
+        self.assertTrue(get_obj('revert_button').get_sensitive())
+        gui.labels.selection.unselect_iter(first.iter)
+        self.assertFalse(get_obj('revert_button').get_sensitive())
+        self.assertFalse(first.label.get_selected())
+        self.assertEqual(first.label.get_property('opacity'), 64)
+        
+        # Known changes are checked against the rows that really changed.
+        known_change({first: True, second: False},
+                     gui.labels.selection.select_iter, first.iter)
+        self.assertEqual(selected, set([first, second]))
+        self.assertTrue(first.label.get_selected())
+        self.assertTrue(second.label.get_selected())
+        refresh(gui.labels.selection)
+        self.assertEqual(selected, set([first, second]))
+        modified.clear()
+    
+    def test_bulk_loading(self):
+        """Make sure that photos are loaded and closed in bulk correctly."""
+        bulk = app.BULK_MINIMUM
+        app.BULK_MINIMUM = 1
+        try:
+            images = [f for f in DEMOFILES if f[-3:] != 'gpx']
+            gui.open_files(images[:1])
+            first = photos.values()[0]
+            gui.labels.selection.select_iter(first.iter)
+            
+            # The selection survives the liststore being detached.
+            gui.open_files(images)
+            self.assertIs(get_obj('photos_view').get_model(), gui.liststore)
+            self.assertEqual(len(gui.liststore), len(images))
+            self.assertEqual(selected, set([first]))
+            self.assertTrue(gui.labels.selection.iter_is_selected(first.iter))
+            self.assertTrue(first.label.get_selected())
+            self.assertTrue(get_obj('close_button').get_sensitive())
+            stamps = [row[app.TIMESTAMP] for row in gui.liststore]
+            self.assertEqual(stamps, sorted(stamps))
+            
+            # Closing some of the photos detaches the liststore too.
+            gui.close_selected_photos()
+            self.assertIs(get_obj('photos_view').get_model(), gui.liststore)
+            self.assertEqual(len(gui.liststore), len(images) - 1)
+            self.assertNotIn(first.filename, photos)
+            self.assertEqual(len(selected), 0)
+            self.assertEqual(len(gui.labels.layer.get_markers()),
+                             len(images) - 1)
+            stamps = [row[app.TIMESTAMP] for row in gui.liststore]
+            self.assertEqual(stamps, sorted(stamps))
+            self.assertFalse(get_obj('close_button').get_sensitive())
+            
+            # Closing every photo clears the liststore and map all at once.
+            gui.labels.selection.select_all()
+            gui.close_selected_photos()
+            self.assertEqual(len(photos), 0)
+            self.assertEqual(len(gui.liststore), 0)
+            self.assertEqual(len(selected), 0)
+            self.assertEqual(len(gui.labels.layer.get_markers()), 0)
+            self.assertFalse(get_obj('close_button').get_sensitive())
+        finally:
+            app.BULK_MINIMUM = bulk
+    
+    def test_thumbnail_budget(self):
+        """Make sure that resident thumbnails are kept within budget."""
+        thumbs = gui.thumbs
+        app.gst.set_int('thumbnail-memory', 8)
+        self.assertEqual(thumbs.stats()['budget'], 8 * 1024 * 1024)
+        misses = thumbs.stats()['misses']
+        images = [f for f in DEMOFILES if f[-3:] != 'gpx']
+        gui.open_files(images)
+        rows = [photos[row[app.PATH]] for row in gui.liststore]
+        last = len(rows) - 1
+        thumbs.visible = lambda: (0, last)
+        while thumbs.load_visible():
+            pass
+        stats = thumbs.stats()
+        self.assertEqual(stats['resident'], len(rows))
+        self.assertEqual(stats['misses'] - misses, len(rows))
+        self.assertGreater(stats['bytes'], 0)
+        self.assertLessEqual(stats['bytes'], stats['budget'])
+        
+        # Thumbnails that are still resident are reused.
+        hits = thumbs.stats()['hits']
+        thumbs.load_visible()
+        self.assertEqual(thumbs.stats()['hits'] - hits, len(rows))
+        
+        # Only the least recently seen thumbnail needs to go.
+        thumbs.visible = lambda: (last, last)
+        thumbs.budget = thumbs.bytes - thumbs.resident[rows[0].filename]
+        thumbs.evict()
+        self.assertLessEqual(thumbs.stats()['bytes'], thumbs.budget)
+        self.assertIsNone(rows[0].thumb)
+        self.assertIsNone(gui.liststore.get_value(rows[0].iter, app.THUMB))
+        for photo in rows[1:]:
+            self.assertIsNotNone(photo.thumb)
+        
+        # Visible thumbnails stay, even when they alone exceed the budget.
+        thumbs.budget = 0
+        thumbs.evict()
+        self.assertEqual(thumbs.stats()['resident'], 1)
+        self.assertIsNotNone(rows[last].thumb)
+        for photo in rows[:last]:
+            self.assertIsNone(photo.thumb)
+        
+        # Evicted rows show a placeholder instead of being blank.
+        cell = app.Gtk.CellRendererPixbuf()
+        app.show_thumbnail(None, cell, gui.liststore, rows[0].iter)
+        self.assertEqual(cell.get_property('stock-id'),
+                         app.Gtk.STOCK_MISSING_IMAGE)
+        app.show_thumbnail(None, cell, gui.liststore, rows[last].iter)
+        self.assertIs(cell.get_property('pixbuf'), rows[last].thumb)
+        
+        del thumbs.visible
+        gui.labels.selection.select_all()
+        gui.close_selected_photos()
+        self.assertEqual(thumbs.stats()['bytes'], 0)
     
     def test_gtk_builder(self):
         """Make sure that various widgets were created properly."""
@@ -314,6 +455,565 @@ class GottenGeographyTester(TestCase):
             self.assertGreater(photo.altitude, 600)
             self.assertEqual(photo.pretty_geoname(), 'Edmonton, Alberta, Canada')
     
+    def test_sniff(self):
+        """Make sure that files are identified by their content."""
+        for filename in DEMOFILES:
+            self.assertEqual(app.sniff(filename),
+                app.GPXFile if filename[-3:] == 'gpx' else Photograph)
+        
+        # Misleading extensions shouldn't matter.
+        impostor = mkstemp('.jpg')[1]
+        with open(impostor, 'w') as gpx:
+            gpx.write('<?xml version="1.0"?>\n<gpx version="1.1">')
+        self.assertEqual(app.sniff(impostor), app.GPXFile)
+        
+        # Files we know nothing about are rejected.
+        with open(impostor, 'w') as text:
+            text.write('Nothing to see here.')
+        system('mv %s %s.txt' % (impostor, impostor))
+        self.assertIsNone(app.sniff(impostor + '.txt'))
+        gui.open_files([impostor + '.txt'])
+        self.assertEqual(len(photos), 0)
+        self.assertEqual(len(points), 0)
+        system('rm -f %s.txt' % impostor)
+    
+    def test_fetch_all(self):
+        """Make sure that metadata read in parallel is the same as serially."""
+        expected = dict([(filename, fetch(filename)) for filename in DEMOFILES])
+        # Enough files that they're read by the pool of worker processes.
+        filenames = DEMOFILES * (PARALLEL_MINIMUM // len(DEMOFILES) + 1)
+        self.assertGreaterEqual(len(filenames), PARALLEL_MINIMUM)
+        results = list(fetch_all(filenames))
+        self.assertEqual([name for name, data in results], filenames)
+        for filename, data in results:
+            self.assertEqual(data, expected[filename])
+            if filename[-3:] == 'gpx':
+                self.assertIsNone(data)
+            else:
+                self.assertIsNotNone(data['original'])
+    
+    def test_read_header(self):
+        """Make sure that the metadata we need is read from JPEG headers."""
+        for filename in DEMOFILES:
+            if filename[-3:] == 'gpx':
+                self.assertRaises(IOError, read_header, filename)
+                continue
+            data = read_header(filename)
+            self.assertEqual(data['camera']['Make'], 'Canon')
+            self.assertEqual(data['original'][:3], (2010, 10, 16))
+            self.assertIsNone(data['latitude'])
+            self.assertEqual(len(data['previews']), 1)
+            offset, length = data['previews'][0]
+            with open(filename, 'rb') as image:
+                image.seek(offset)
+                self.assertEqual(jpeg_dimensions(image.read(length)),
+                                 (160, 120))
+    
+    def test_strip_previews(self):
+        """Make sure that previews stored as JPEG strips are found in RAWs."""
+        filename = [f for f in DEMOFILES if f[-3:] == 'JPG'][0]
+        offset, length = read_header(filename)['previews'][0]
+        with open(filename, 'rb') as image:
+            image.seek(offset)
+            jpeg = image.read(length)
+        
+        # IFD0 holds an old style JPEG strip, like CR2. IFD1 holds lossless
+        # JPEG RAW data, which isn't a preview because it's full resolution.
+        entry = lambda tag, kind, value: pack('<HHII', tag, kind, 1, value)
+        ifd = lambda entries, after: (pack('<H', len(entries)) +
+            ''.join(entries) + pack('<I', after))
+        strip = 8 + 2 * (2 + 3 * 12 + 4) + 12
+        header = ('II*\x00' + pack('<I', 8) +
+            ifd([entry(0x0103, 3, 6), entry(0x0111, 4, strip),
+                 entry(0x0117, 4, len(jpeg))], 50) +
+            ifd([entry(0x00FE, 4, 0), entry(0x0103, 3, 7),
+                 entry(0x0111, 4, strip)], 0))
+        header += ' ' * (strip - len(header))
+        raw = mkstemp('.cr2')[1]
+        with open(raw, 'wb') as image:
+            image.write(header + jpeg)
+        self.assertEqual(read_header(raw)['previews'], [(strip, len(jpeg))])
+        self.assertEqual(read_previews(raw), [((160, 120), jpeg)])
+        
+        # That preview is too small to be shared through the cache.
+        thumb, complete = Photograph(raw, lambda x: None).create_thumbnail(256)
+        self.assertFalse(complete)
+        self.assertEqual((thumb.get_width(), thumb.get_height()), (160, 120))
+        system('rm -f ' + raw)
+    
+    def test_tiff_thumbnail(self):
+        """Make sure that TIFFs without previews still get thumbnails."""
+        filename = [f for f in DEMOFILES if f[-3:] == 'JPG'][0]
+        tiff = mkstemp('.tif')[1]
+        GdkPixbuf.Pixbuf.new_from_file(filename).savev(tiff, 'tiff', [], [])
+        photo = Photograph(tiff, lambda x: None)
+        thumb, complete = photo.create_thumbnail(128)
+        self.assertTrue(complete)
+        self.assertEqual(max(thumb.get_width(), thumb.get_height()), 128)
+        system('rm -f ' + tiff)
+    
+    def test_thumbnail_cache(self):
+        """Make sure that thumbnails are shared through the standard cache."""
+        original = mkstemp('.jpg')[1]
+        utime(original, (1000000000, 1000000000))
+        uri = GLib.filename_to_uri(original, None)
+        normal = thumbnails.thumbnail_path(uri, thumbnails.NORMAL)
+        large  = thumbnails.thumbnail_path(uri, 200)
+        self.assertEqual(normal, join(GLib.get_user_cache_dir(), 'thumbnails',
+            'normal', md5(uri).hexdigest() + '.png'))
+        self.assertEqual(large, join(GLib.get_user_cache_dir(), 'thumbnails',
+            'large', md5(uri).hexdigest() + '.png'))
+        self.assertIsNone(thumbnails.load(original, thumbnails.NORMAL))
+        
+        # Thumbnails are renamed into place, readable only by the user.
+        pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, 64, 48)
+        pixbuf.fill(0x336699ff)
+        cache = GLib.path_get_dirname(normal)
+        before = set(listdir(cache)) if exists(cache) else set()
+        thumbnails.save(original, pixbuf, thumbnails.NORMAL)
+        self.assertEqual(stat(normal).st_mode & 0777, 0600)
+        self.assertEqual(set(listdir(cache)) - before,
+                         set([GLib.path_get_basename(normal)]))
+        thumb = thumbnails.load(original, thumbnails.NORMAL)
+        self.assertEqual(thumb.get_option(thumbnails.URI), uri)
+        self.assertEqual(thumb.get_option(thumbnails.MTIME), '1000000000')
+        thumb = thumbnails.load(original, 32)
+        self.assertEqual((thumb.get_width(), thumb.get_height()), (32, 24))
+        
+        # Thumbnails of older versions of the file are ignored until restamped.
+        utime(original, (1000000100, 1000000100))
+        self.assertIsNone(thumbnails.load(original, thumbnails.NORMAL))
+        thumbnails.restamp(original, 1000000000)
+        thumb = thumbnails.load(original, thumbnails.NORMAL)
+        self.assertEqual(thumb.get_option(thumbnails.MTIME), '1000000100')
+        
+        # Thumbnails of some other file, with a colliding name, are ignored.
+        pixbuf.savev(normal, 'png', [thumbnails.URI, thumbnails.MTIME],
+                     ['file:///elsewhere.jpg', '1000000100'])
+        self.assertIsNone(thumbnails.load(original, thumbnails.NORMAL))
+        system('rm -f %s %s %s' % (original, normal, large))
+    
+    def test_patch_header(self):
+        """Make sure that GPS tags are patched in place when they fit."""
+        for filename in DEMOFILES:
+            if filename[-3:] == 'gpx':
+                continue
+            with open(filename, 'rb') as image:
+                original = image.read()
+            self.assertRaises(IOError, patch_header, filename,
+                              {'LatitudeRef': 'N'}, {})
+            with open(filename, 'rb') as image:
+                self.assertEqual(image.read(), original)
+        
+        # The first save rewrites the photo, creating it's GPS IFD.
+        filename = [f for f in DEMOFILES if f[-3:] == 'JPG'][0]
+        photo = Photograph(filename, lambda x: None)
+        photo.read()
+        photo.latitude  = 53.5
+        photo.longitude = -113.5
+        photo.altitude  = 650.0
+        photo.write()
+        size = stat(filename).st_size
+        
+        # The second fits in the existing tags, so only they're overwritten.
+        photo.latitude  = -10.25
+        photo.longitude = 20.75
+        photo.altitude  = -15.0
+        gps = dict([(key[len(GPS):], value)
+                    for key, value in encode(photo.geotags()).items()
+                    if key.startswith(GPS)])
+        self.assertTrue(patch_header(filename, gps, {}))
+        self.assertEqual(stat(filename).st_size, size)
+        data = read_header(filename)
+        self.assertAlmostEqual(data['latitude'], -10.25)
+        self.assertAlmostEqual(data['longitude'], 20.75)
+        self.assertAlmostEqual(data['altitude'], -15.0)
+        
+        # Saving the same values again writes nothing at all.
+        with open(filename, 'rb') as image:
+            patched = image.read()
+        self.assertFalse(patch_header(filename, gps, {}))
+        self.assertIsNone(write_metadata(photo.geotags()))
+        with open(filename, 'rb') as image:
+            self.assertEqual(image.read(), patched)
+        
+        # Values that point past the end of the Exif segment aren't patched.
+        with open(filename, 'rb') as image:
+            for position, marker, segment in jpeg_segments(image):
+                if marker == '\xe1' and segment.startswith('Exif\x00\x00'):
+                    break
+            reader = TIFFReader(image, position + 10, segment[6:])
+            offset = reader.offset(reader.ifd(reader.unpack('I', 4)[0])[GPS_IFD])
+            for entry in range(offset + 2, offset + 2 +
+                               reader.unpack('H', offset)[0] * 12, 12):
+                if reader.unpack('H', entry)[0] == 2: # GPSLatitude
+                    break
+        pointer = position + 10 + entry + 8
+        corrupt = mkstemp('.jpg')[1]
+        with open(corrupt, 'wb') as image:
+            image.write(patched[:pointer] +
+                        pack(reader.endian + 'I', len(segment) - 6) +
+                        patched[pointer + 4:])
+        with open(corrupt, 'rb') as image:
+            original = image.read()
+        self.assertRaises(IOError, patch_header, corrupt, gps, {})
+        with open(corrupt, 'rb') as image:
+            self.assertEqual(image.read(), original)
+        system('rm -f ' + corrupt)
+    
+    def test_save_all(self):
+        """Make sure that photos are saved atomically, in parallel or not."""
+        source = [f for f in DEMOFILES if f[-3:] == 'JPG'][0]
+        directory = mkdtemp()
+        pooled, alone = [], []
+        for i in range(PARALLEL_MINIMUM):
+            for kind, jobs in (('pooled', pooled), ('alone', alone)):
+                filename = join(directory, '%s%d.jpg' % (kind, i))
+                system('cp %s %s' % (source, filename))
+                jobs.append((filename, i / 2, -i, float(i),
+                             {'City': ['Edmonton']}))
+        
+        # The pool writes exactly what saving one photo at a time would.
+        self.assertEqual(sorted(save_all(pooled, lambda: None)),
+                         sorted([(job[0], None) for job in pooled]))
+        for job in alone:
+            self.assertEqual(list(save_all([job], lambda: None)),
+                             [(job[0], None)])
+        for first, second in zip(pooled, alone):
+            with open(first[0], 'rb') as one, open(second[0], 'rb') as two:
+                self.assertEqual(one.read(), two.read())
+        
+        # A save that fails partway leaves no trace, and reports why.
+        filename = pooled[0][0]
+        with open(filename, 'rb') as image:
+            original = image.read()
+        result = list(save_all([(filename, 1.0, 1.0, None,
+                                 {'Bogus': ['Invalid IPTC key']})],
+                               lambda: None))
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0][0], filename)
+        self.assertIsNotNone(result[0][1])
+        with open(filename, 'rb') as image:
+            self.assertEqual(image.read(), original)
+        self.assertEqual([name for name in listdir(directory)
+                          if name.startswith('.')], [])
+        
+        # Symlinks are followed, and hard links are kept.
+        target = alone[0][0]
+        save = lambda filename, city: list(save_all(
+            [(filename, 5.0, 1.0, None, {'City': [city]})], lambda: None))
+        symbolic = join(directory, 'symbolic.jpg')
+        symlink(target, symbolic)
+        self.assertEqual(save(symbolic, 'Calgary'), [(symbolic, None)])
+        self.assertTrue(islink(symbolic))
+        self.assertEqual(read_header(target)['geonames']['City'], ['Calgary'])
+        hard = join(directory, 'hard.jpg')
+        link(target, hard)
+        self.assertEqual(save(hard, 'Red Deer'), [(hard, None)])
+        self.assertEqual(stat(hard).st_ino, stat(target).st_ino)
+        self.assertEqual(read_header(target)['geonames']['City'], ['Red Deer'])
+        system('rm -rf ' + directory)
+    
+    def test_sidecars(self):
+        """Make sure that geotags can be saved to and read from sidecars."""
+        self.assertEqual(encode_coordinate(53.5417, 'NS'), '53,32.50200N')
+        self.assertEqual(encode_coordinate(-113.5, 'EW'), '113,30.00000W')
+        self.assertAlmostEqual(decode_coordinate('53,32.502N'), 53.5417)
+        self.assertAlmostEqual(decode_coordinate('113,30,0W'), -113.5)
+        
+        filename = [f for f in DEMOFILES if f[-3:] == 'JPG'][0]
+        with open(filename, 'rb') as image:
+            original = image.read()
+        photo = Photograph(filename, lambda x: None)
+        photo.read()
+        photo.latitude  = 53.5417
+        photo.longitude = -113.5
+        photo.altitude  = 650.5
+        photo.geonames  = {'City': ['Edmonton']}
+        photo.write(sidecar=True)
+        with open(filename, 'rb') as image:
+            self.assertEqual(image.read(), original)
+        mask = umask(0)
+        umask(mask)
+        self.assertEqual(stat(filename + '.xmp').st_mode & 0777,
+                         0666 & ~mask)
+        self.assertEqual(find_sidecar(filename), filename + '.xmp')
+        
+        photo = Photograph(filename, lambda x: None)
+        photo.read(sidecars=True)
+        self.assertAlmostEqual(photo.latitude, 53.5417)
+        self.assertAlmostEqual(photo.longitude, -113.5)
+        self.assertAlmostEqual(photo.altitude, 650.5)
+        self.assertEqual(photo.geonames['City'], ['Edmonton'])
+        
+        # Sidecars are ignored while they aren't being saved to.
+        photo = Photograph(filename, lambda x: None)
+        photo.read()
+        self.assertIsNone(photo.latitude)
+        
+        # Turning sidecars off between saves still writes into the photo,
+        # even though the photo already had these geotags in it's sidecar.
+        app.gst.set_boolean('xmp-sidecars', True)
+        gui.open_files([filename])
+        photo = photos[filename]
+        self.assertAlmostEqual(photo.latitude, 53.5417)
+        app.gst.set_boolean('xmp-sidecars', False)
+        photo.set_location(53.5417, -113.5)
+        gui.save_all_files()
+        self.assertEqual(len(modified), 0)
+        photo.set_location(10.0, 10.0)
+        gui.save_all_files()
+        gui.labels.selection.select_all()
+        gui.close_selected_photos()
+        gui.open_files([filename])
+        self.assertAlmostEqual(photos[filename].latitude, 10.0)
+        self.assertAlmostEqual(photos[filename].longitude, 10.0)
+        gui.labels.selection.select_all()
+        gui.close_selected_photos()
+        
+        app.gst.set_boolean('xmp-sidecars', True)
+        photo = Photograph(filename, lambda x: None)
+        photo.read(sidecars=True)
+        self.assertAlmostEqual(photo.latitude, 53.5417)
+        system('rm -f %s.xmp' % filename)
+    
+    def test_timezones(self):
+        """Make sure that camera clocks are converted without using TZ."""
+        edmonton = get_zone('America/Edmonton')
+        self.assertIs(edmonton, get_zone('America/Edmonton'))
+        self.assertEqual(edmonton.epoch(
+            naive_seconds((2010, 10, 16, 13, 0, 0))), 1287255600)
+        self.assertEqual(edmonton.epoch(
+            naive_seconds((2010, 1, 1, 0, 0, 0))), 1262329200)
+        self.assertEqual(get_zone('Nowhere/Special').epoch(1000), 1000)
+        
+        filename = [f for f in DEMOFILES if f[-3:] == 'JPG'][0]
+        photo = Photograph(filename, lambda x: None)
+        photo.read()
+        photo.calculate_timestamp(edmonton)
+        stamp = photo.timestamp
+        photo.calculate_timestamp(get_zone('Europe/Paris'))
+        self.assertEqual(stamp - photo.timestamp, 8 * 3600)
+    
+    def test_estimate_offset(self):
+        """Make sure that the clock offset is found from geotagged photos."""
+        start = 1287259751
+        for i in range(0, 7200, 10):
+            points[start + i] = Struct({'lat': i / 7200, 'lon': 0.0,
+                                        'ele': 0.0})
+        app.metadata.alpha = start
+        app.metadata.omega = start + 7190
+        self.assertEqual(app.estimate_offset(), None)
+        
+        for i in range(20):
+            photo = Photograph('/tmp/estimate%d.jpg' % i, lambda x: None)
+            photo.timestamp = start + 300 + i * 300 - 754
+            photo.geotagged = ((300 + i * 300) / 7200, 0.0)
+            photos[photo.filename] = photo
+        self.assertEqual(app.estimate_offset(), 754)
+        
+        # Positions that were only saved by us don't count.
+        for i in range(20, 40):
+            photo = Photograph('/tmp/estimate%d.jpg' % i, lambda x: None)
+            photo.timestamp = start + i * 100
+            photo.snapshot  = (0, 0.9, 0.0, None, {})
+            photos[photo.filename] = photo
+        self.assertEqual(app.estimate_offset(), 754)
+        
+        for i in range(40):
+            del photos['/tmp/estimate%d.jpg' % i]
+        app.clear_all_gpx()
+    
+    def test_camera_registry(self):
+        """Make sure that each camera is only created once."""
+        canon = get_camera({'Make': 'Canon', 'Model': 'Canon PowerShot'})
+        self.assertIs(canon, get_camera({'Model': 'Canon PowerShot',
+                                         'Make': 'Canon'}))
+        self.assertIs(canon, cameras[canon.id])
+        self.assertEqual(canon.id, 'canon_canon_powershot')
+        self.assertEqual(canon.gst.get_string('model'), 'Canon PowerShot')
+        unknown = get_camera({})
+        self.assertIsNot(canon, unknown)
+        self.assertEqual(unknown.gst.get_string('make'), 'Unknown Make')
+        
+        # Cameras follow the preferences unless given settings of their own.
+        self.assertIs(canon.timezone(), clock.zone)
+        self.assertEqual(canon.offset, 0)
+        canon.gst.set_int('offset', 90)
+        canon.gst.set_string('timezone-method', 'custom')
+        canon.gst.set_int('timezone-region', tz_regions.index('Europe'))
+        canon.gst.set_int('timezone-cities',
+                          get_timezone('Europe').index('Paris'))
+        canon.update()
+        self.assertEqual(canon.offset, 90)
+        self.assertIs(canon.timezone(), get_zone('Europe/Paris'))
+        
+        # Only the camera's own photos are moved into it's new timezone.
+        paris = get_zone('Europe/Paris')
+        photo = Photograph('/tmp/camera.jpg', lambda x: None)
+        other = Photograph('/tmp/other.jpg', lambda x: None)
+        photo.camera, other.camera = canon, unknown
+        photo.original = other.original = 1000000000
+        other.timestamp = 0
+        photos.update({photo.filename: photo, other.filename: other})
+        canon.apply()
+        self.assertEqual(photo.timestamp, paris.epoch(1000000000))
+        self.assertEqual(photo.pretty_time(), paris.format(photo.timestamp))
+        self.assertEqual(other.timestamp, 0)
+        del photos[photo.filename]
+        del photos[other.filename]
+        canon.gst.reset('offset')
+        canon.gst.reset('timezone-method')
+        canon.update()
+        self.assertIs(canon.timezone(), clock.zone)
+    
+    def test_revert(self):
+        """Make sure that photos are reverted without rereading them."""
+        filename = [f for f in DEMOFILES if f[-3:] == 'JPG'][0]
+        photo = Photograph(filename, lambda x: None)
+        photo.read()
+        photo.latitude  = 53.5
+        photo.longitude = -113.5
+        photo.geonames  = {'City': ['Edmonton']}
+        self.assertFalse(photo.unchanged())
+        self.assertTrue(photo.revert())
+        self.assertIsNone(photo.latitude)
+        self.assertIsNone(photo.longitude)
+        self.assertEqual(photo.geonames, {})
+        self.assertTrue(photo.unchanged())
+        
+        # Once changed on disk, the photo has to be read again.
+        mtime = stat(filename).st_mtime
+        utime(filename, (mtime + 10, mtime + 10))
+        self.assertFalse(photo.revert())
+    
+    def test_gpx_append(self):
+        """Make sure that growing GPX files are extended, not duplicated."""
+        gpx_filename = join(PKG_DATA_DIR, '..', 'demo', '20101016.gpx')
+        with open(gpx_filename) as gpx:
+            data = gpx.read()
+        
+        # Cut the file off in the middle of a track point.
+        middle = data.index('<trkpt', len(data) // 2) + 20
+        partial = mkstemp('.gpx')[1]
+        with open(partial, 'w') as gpx:
+            gpx.write(data[:middle])
+        
+        gui.load_gpx_from_file(partial)
+        loaded = len(points)
+        self.assertGreater(loaded, 100)
+        self.assertLess(loaded, 374)
+        self.assertEqual(len(polygons), 1)
+        self.assertIn(partial, trackfiles)
+        
+        # Finish writing the file, as though the logger was still going.
+        with open(partial, 'a') as gpx:
+            gpx.write(data[middle:])
+        
+        gui.load_gpx_from_file(partial)
+        self.assertEqual(len(points), 374)
+        self.assertEqual(len(polygons), 1)
+        self.assertEqual(len(polygons[0].get_nodes()), 374)
+        self.assertEqual(app.metadata.alpha, 1287259751)
+        self.assertEqual(app.metadata.omega, 1287260756)
+        
+        # Loading it again unchanged shouldn't add anything.
+        gui.load_gpx_from_file(partial)
+        self.assertEqual(len(polygons[0].get_nodes()), 374)
+        
+        get_obj('clear_button').emit('clicked')
+        self.assertEqual(len(trackfiles), 0)
+        system('rm -f ' + partial)
+    
+    def test_compressed_gpx(self):
+        """Make sure that compressed GPX files can be loaded."""
+        gpx_filename = join(PKG_DATA_DIR, '..', 'demo', '20101016.gpx')
+        compressed = mkstemp('.gpx.gz')[1]
+        with open(gpx_filename) as gpx:
+            gzipped = GzipFile(compressed, 'wb')
+            gzipped.write(gpx.read())
+            gzipped.close()
+        
+        gui.load_gpx_from_file(compressed)
+        self.assertEqual(len(points), 374)
+        self.assertEqual(len(polygons), 1)
+        self.assertEqual(app.metadata.alpha, 1287259751)
+        self.assertEqual(app.metadata.omega, 1287260756)
+        
+        get_obj('clear_button').emit('clicked')
+        system('rm -f ' + compressed)
+    
+    def test_fit(self):
+        """Make sure that FIT activity files can be loaded."""
+        semicircles = lambda degrees: int(degrees * 2**31 / 180)
+        
+        # Define local message 0 as a record with timestamp, lat, lon, alt.
+        data = pack('<BBBHB', 0x40, 0, 0, 20, 4) + pack('12B',
+            253, 4, 0x86, 0, 4, 0x85, 1, 4, 0x85, 2, 2, 0x84)
+        for second in range(10):
+            data += pack('<BIiiH', 0, 1287259751 - 631065600 + second,
+                semicircles(53.52263), semicircles(-113.448979),
+                (671 + 500) * 5)
+        
+        filename = mkstemp('.fit')[1]
+        with open(filename, 'wb') as fit:
+            fit.write(pack('<BBHI4sH', 14, 16, 2000, len(data), '.FIT', 0))
+            fit.write(data + pack('<H', 0))
+        
+        gui.load_gpx_from_file(filename)
+        self.assertEqual(len(points), 10)
+        self.assertEqual(len(polygons), 1)
+        self.assertEqual(app.metadata.alpha, 1287259751)
+        self.assertEqual(app.metadata.omega, 1287259760)
+        for point in points.values():
+            self.assertAlmostEqual(point.lat, 53.52263, 5)
+            self.assertAlmostEqual(point.lon, -113.448979, 5)
+            self.assertAlmostEqual(point.ele, 671, 5)
+        
+        get_obj('clear_button').emit('clicked')
+        system('rm -f ' + filename)
+    
+    def test_nmea(self):
+        """Make sure that NMEA logs can be loaded."""
+        sentence = lambda body: '$%s*%02X\r\n' % (
+            body, reduce(xor, bytearray(body), 0))
+        log = ['@Sonygps/ver1.0/wgs-84\n']
+        for second in range(10):
+            log.append(sentence('GPGGA,2009%02d.000,5331.358,N,11326.939,W,'
+                                '1,08,0.9,%d.4,M,-17.0,M,,' % (second, 670)))
+            log.append(sentence('GPRMC,2009%02d.000,A,5331.358,N,11326.939,W,'
+                                '0.0,0.0,161010,,' % second))
+        log.append(sentence('GPGSV,3,1,11,03,03,111,00,04,15,270,00,06,'
+                            '01,010,00,13,06,292,00'))
+        log[4] = log[4].replace('5331', '5332') # Corrupt the checksum.
+        log.append(log[-1][:20]) # Unfinished line.
+        
+        filename = mkstemp('.nmea')[1]
+        with open(filename, 'w') as nmea:
+            nmea.write(''.join(log))
+        
+        gui.load_gpx_from_file(filename)
+        self.assertEqual(len(points), 9)
+        self.assertEqual(len(polygons), 1)
+        self.assertEqual(app.metadata.alpha, 1287259740)
+        self.assertEqual(app.metadata.omega, 1287259749)
+        for point in points.values():
+            self.assertAlmostEqual(point.lat, 53.52263, 5)
+            self.assertAlmostEqual(point.lon, -113.44898, 5)
+            self.assertAlmostEqual(point.ele, 670.4, 5)
+        
+        get_obj('clear_button').emit('clicked')
+        
+        # A log without a single fix is rejected, instead of being empty.
+        with open(filename, 'w') as nmea:
+            nmea.write(''.join([sentence('GPRMC,2009%02d.000,V,,,,,,,161010,,'
+                                         % second) for second in range(10)]))
+        self.assertRaises(IOError, gui.load_gpx_from_file, filename)
+        gui.open_files([filename])
+        self.assertEqual(len(points), 0)
+        self.assertEqual(len(trackfiles), 0)
+        system('rm -f ' + filename)
+    
     def test_auto_timestamp(self):
         """Ensure that we can determine the correct timezone if it is set incorrectly."""
         environ['TZ'] = 'Europe/Paris'
@@ -367,6 +1067,11 @@ S 10.00000, W 10.00000
 S 10.00000, W 10.00000
 600.7m above sea level</span>""")
         
+        # The summary is only rebuilt once something in it has changed.
+        self.assertIs(photo.long_summary(), photo.long_summary())
+        photo.altitude = -5.0
+        self.assertIn('5.0m below sea level', photo.long_summary())
+        
         self.assertRegexpMatches(
             get_obj('maps_link').get_label(),
             r'href="http://maps.google.com'
@@ -580,6 +1285,11 @@ S 10.00000, W 10.00000
         self.assertEqual(seconds.get_value(), 0)
         self.assertEqual(minutes.get_value(), 60)
         self.assertEqual(app.metadata.delta, 3600)
+        
+        # All those changes only move the photos once.
+        self.assertIsNotNone(gui.offset_source)
+        self.assertFalse(gui.apply_time_offset())
+        self.assertIsNone(gui.offset_source)
     
     def test_search(self):
         """Make sure the search box functions."""
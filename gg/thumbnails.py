@@ -0,0 +1,115 @@
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Share thumbnails with other applications through the thumbnail cache.
+
+This follows the freedesktop.org Thumbnail Managing Standard, so thumbnails
+created by the file manager are used by GottenGeography and vice versa. Each
+thumbnail is a PNG named after the MD5 of the original file's URI, and
+records the original file's mtime so that stale thumbnails can be detected
+without having to look inside the original file at all.
+"""
+
+from __future__ import division
+
+from gi.repository import GLib, GObject, GdkPixbuf
+from os import close, chmod, makedirs, rename, stat, unlink
+from os.path import join, isdir, dirname
+from tempfile import mkstemp
+from hashlib import md5
+
+# The standard defines these two sizes, in pixels.
+NORMAL = 128
+LARGE  = 256
+
+URI   = 'tEXt::Thumb::URI'
+MTIME = 'tEXt::Thumb::MTime'
+
+
+def thumbnail_path(uri, size):
+    """Determine where the thumbnail for the given URI belongs."""
+    return join(GLib.get_user_cache_dir(), 'thumbnails',
+        'normal' if size <= NORMAL else 'large',
+        md5(uri).hexdigest() + '.png')
+
+def scale(pixbuf, size):
+    """Shrink a pixbuf to fit within size, maintaining it's aspect ratio."""
+    width, height = pixbuf.get_width(), pixbuf.get_height()
+    if max(width, height) <= size:
+        return pixbuf
+    ratio = size / max(width, height)
+    return pixbuf.scale_simple(max(int(width * ratio), 1),
+                               max(int(height * ratio), 1),
+                               GdkPixbuf.InterpType.BILINEAR)
+
+def load(filename, size):
+    """Load a cached thumbnail, returning None if it's missing or stale."""
+    try:
+        mtime = str(int(stat(filename).st_mtime))
+        uri = GLib.filename_to_uri(filename, None)
+    except (OSError, GObject.GError):
+        return None
+    for cache_size in (LARGE, NORMAL) if size > NORMAL else (NORMAL, LARGE):
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file(
+                thumbnail_path(uri, cache_size))
+        except GObject.GError:
+            continue
+        if pixbuf.get_option(URI) == uri and pixbuf.get_option(MTIME) == mtime:
+            return scale(pixbuf, size)
+
+def save(filename, pixbuf, size=LARGE):
+    """Store a thumbnail into the cache.
+    
+    The pixbuf should be no larger than size. It's written to a temporary
+    file first and then renamed into place, as required by the standard, so
+    that other applications never see a partially written thumbnail.
+    """
+    try:
+        mtime = stat(filename).st_mtime
+        uri = GLib.filename_to_uri(filename, None)
+        path = thumbnail_path(uri, size)
+        directory = dirname(path)
+        if not isdir(directory):
+            makedirs(directory, 0700)
+        handle, temp = mkstemp('.png', '', directory)
+        close(handle)
+        try:
+            pixbuf.savev(temp, 'png', [URI, MTIME],
+                         [uri, str(int(mtime))])
+            chmod(temp, 0600)
+            rename(temp, path)
+        except GObject.GError:
+            unlink(temp)
+    except (OSError, GObject.GError):
+        pass
+
+def restamp(filename, old_mtime):
+    """Update a cached thumbnail after modifying only the file's metadata.
+    
+    Writing geotags changes the mtime of the file but not what it looks
+    like, so there's no need to throw the existing thumbnail away.
+    """
+    try:
+        uri = GLib.filename_to_uri(filename, None)
+    except GObject.GError:
+        return
+    for size in (NORMAL, LARGE):
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file(thumbnail_path(uri, size))
+        except GObject.GError:
+            continue
+        if pixbuf.get_option(MTIME) == str(int(old_mtime)):
+            save(filename, pixbuf, size)
@@ -0,0 +1,160 @@
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Load thumbnails only for the photos that can actually be seen.
+
+Photos are loaded without thumbnails, so the photo pane shows a placeholder
+icon for each of them at first. Whenever the pane is scrolled or resized, or
+photos are added to it, the rows that are visible get their thumbnails loaded
+in idle time, followed by the rows within one screenful above and below, in
+order of their distance from what's visible. Thumbnails are loaded a few at a
+time so that the interface stays responsive while scrolling.
+
+Each thumbnail pixbuf costs width * height * 4 bytes, so the thumbnails that
+are held in memory are limited by the thumbnail-memory setting. Once that is
+exceeded, the least recently seen thumbnails are dropped, and are reloaded
+from the on-disk thumbnail cache (where they're stored as compressed PNGs) if
+they ever scroll back into view.
+"""
+
+from __future__ import division
+
+from gi.repository import GLib
+from collections import OrderedDict
+from time import time
+
+from common import get_obj, gst, photos, PATH, THUMB
+
+# Maximum number of seconds to spend loading thumbnails in each idle call.
+TIME_SLICE = 0.05
+
+
+class ThumbnailController():
+    """Fill in the thumbnails of the visible rows of the photo pane."""
+    
+    def __init__(self):
+        self.view = get_obj('photos_view')
+        self.liststore = get_obj('loaded_photos')
+        self.failed = set()
+        self.source = None
+        
+        # Maps filenames to the size in bytes of their resident thumbnails,
+        # ordered from least to most recently seen.
+        self.resident = OrderedDict()
+        self.bytes  = 0
+        self.hits   = 0
+        self.misses = 0
+        self.budget = 0
+        self.set_budget()
+        
+        self.view.get_vadjustment().connect('value-changed', self.schedule)
+        self.view.connect('size-allocate', self.schedule)
+        self.liststore.connect('row-inserted', self.schedule)
+        self.liststore.connect('rows-reordered', self.schedule)
+        gst.connect('changed::thumbnail-memory', self.set_budget)
+    
+    def set_budget(self, *ignored):
+        """Read the memory budget, in megabytes, from GSettings."""
+        self.budget = gst.get_int('thumbnail-memory') * 1024 * 1024
+        self.evict()
+    
+    def stats(self):
+        """Report how well the resident thumbnails are being reused."""
+        return dict(hits=self.hits, misses=self.misses, bytes=self.bytes,
+                    resident=len(self.resident), budget=self.budget)
+    
+    def schedule(self, *ignored):
+        """Arrange for the visible thumbnails to be loaded when idle."""
+        if self.source is None:
+            self.source = GLib.idle_add(self.load_visible,
+                                        priority=GLib.PRIORITY_LOW)
+    
+    def visible(self):
+        """Return the indices of the first and last visible rows."""
+        visible = self.view.get_visible_range()
+        if not visible:
+            return None
+        return visible[0].get_indices()[0], visible[1].get_indices()[0]
+    
+    def wanted(self):
+        """List the rows that need thumbnails, nearest to the view first."""
+        if self.visible() is None:
+            return []
+        first, last = self.visible()
+        margin = last - first + 1
+        distance = lambda row: max(first - row, row - last, 0)
+        return sorted(range(max(first - margin, 0),
+                            min(last + margin + 1, len(self.liststore))),
+                      key=distance)
+    
+    def load_visible(self):
+        """Load thumbnails until they're all loaded or time runs out."""
+        deadline = time() + TIME_SLICE
+        for row in self.wanted():
+            treeiter = self.liststore.get_iter(row)
+            filename = self.liststore.get_value(treeiter, PATH)
+            if filename in self.resident:
+                self.hits += 1
+                self.resident[filename] = self.resident.pop(filename)
+                continue
+            photo = photos.get(filename)
+            if photo is None or filename in self.failed:
+                continue
+            self.misses += 1
+            if photo.thumb is None:
+                try:
+                    photo.read_thumbnail()
+                except IOError:
+                    self.failed.add(filename)
+                    continue
+            self.liststore.set_value(treeiter, THUMB, photo.thumb)
+            size = photo.thumb.get_rowstride() * photo.thumb.get_height()
+            self.resident[filename] = size
+            self.bytes += size
+            if time() > deadline:
+                self.evict()
+                return True
+        self.evict()
+        self.source = None
+        return False
+    
+    def evict(self):
+        """Drop the least recently seen thumbnails until within budget.
+        
+        Thumbnails in the visible rows are never dropped, even if they alone
+        exceed the budget, because they would just be reloaded right away.
+        """
+        if self.bytes <= self.budget:
+            return
+        keep = set()
+        if self.visible() is not None:
+            first, last = self.visible()
+            keep = set([self.liststore[row][PATH]
+                        for row in range(first, last + 1)])
+        for filename in list(self.resident):
+            if self.bytes <= self.budget:
+                break
+            if filename not in keep:
+                self.forget(filename)
+    
+    def forget(self, filename):
+        """Release the thumbnail of the given photo from memory."""
+        self.bytes -= self.resident.pop(filename, 0)
+        self.failed.discard(filename)
+        photo = photos.get(filename)
+        if photo is not None:
+            photo.thumb = None
+            if photo.iter is not None:
+                self.liststore.set_value(photo.iter, THUMB, None)
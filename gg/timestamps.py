@@ -0,0 +1,95 @@
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Convert the times recorded by camera clocks into epoch seconds.
+
+Cameras record when each photo was taken without saying what timezone their
+clock was set to. Instead of setting the TZ environment variable and calling
+tzset, which changes the behavior of the whole process, the chosen timezone
+is loaded as a dateutil tzinfo and applied explicitly, so conversions can
+happen from any thread.
+
+Photos keep their capture time in seconds as though the camera were set to
+UTC, so converting it only means subtracting the UTC offset of the timezone
+at that moment. Offsets only change at DST transitions, which happen on the
+hour, so they're memoized by the hour and changing the timezone costs one
+dict lookup per photo.
+"""
+
+from __future__ import division
+
+from datetime import datetime, timedelta
+from calendar import timegm
+from dateutil.tz import gettz, tzutc
+
+EPOCH = datetime(1970, 1, 1)
+
+# Timezones that have been loaded already, by name.
+zones = {}
+
+
+def get_zone(name=None):
+    """Find the Timezone of the given name, or of the system if None."""
+    if name is None:
+        return Timezone(None)
+    if name not in zones:
+        zones[name] = Timezone(name)
+    return zones[name]
+
+def naive_seconds(timetuple):
+    """Count the seconds to a local time, as though it were UTC."""
+    return timegm(timetuple)
+
+
+class Timezone():
+    """Apply the rules of one timezone to local times."""
+    
+    def __init__(self, name):
+        """Unknown names fall back to UTC, just as with TZ."""
+        self.name = name
+        if name is None:
+            self.tzinfo = gettz() or tzutc()
+        else:
+            self.tzinfo = (gettz(name) if name else None) or tzutc()
+        self.offsets = {}
+    
+    def offset(self, naive):
+        """Find the UTC offset in seconds at the given local time."""
+        hour = naive // 3600
+        if hour not in self.offsets:
+            local = (EPOCH + timedelta(hours=hour)).replace(tzinfo=self.tzinfo)
+            delta = local.utcoffset()
+            self.offsets[hour] = delta.days * 86400 + delta.seconds
+        return self.offsets[hour]
+    
+    def epoch(self, naive):
+        """Convert a local time into epoch seconds."""
+        return int(naive - self.offset(naive))
+    
+    def format(self, epoch):
+        """Display epoch seconds as a local date and time."""
+        return datetime.fromtimestamp(epoch, self.tzinfo).strftime(
+            '%Y-%m-%d %X')
+
+
+class clock:
+    """Records the timezone that camera clocks are assumed to be set to.
+    
+    The timezone of the place where the GPS track was recorded is kept too,
+    for cameras that are set to use it. Never instantiated, simply used for
+    static class attributes.
+    """
+    zone   = get_zone()
+    lookup = None
@@ -13,23 +13,115 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Define classes used for parsing GPX and KML XML files."""
+"""Define classes used for parsing GPX and KML XML files.
+
+Logs of NMEA 0183 sentences, which are plain text rather than XML, and FIT
+activity files, which are binary, are also handled here because they feed
+into the same TrackFile machinery.
+
+Track files may also be compressed with gzip, bzip2 or xz, and KML may be
+zipped up as KMZ. These are decompressed on the fly while they are parsed.
+"""
 
 from __future__ import division
 
 from xml.parsers.expat import ParserCreate, ExpatError
 from dateutil.parser import parse as parse_date
+from xml.sax.saxutils import quoteattr
+from zipfile import ZipFile, BadZipfile
+from contextlib import contextmanager
 from re import compile as re_compile
 from gi.repository import Gtk
+from itertools import izip
+from operator import xor
 from calendar import timegm
+from gzip import GzipFile
+from bz2 import BZ2File
 from time import clock
 
-from gpsmath import Coordinates
+try:
+    from backports.lzma import LZMAFile
+except ImportError:
+    LZMAFile = None
+
+from gpsmath import Coordinates, dms_to_decimal
+from fit import decode as decode_fit
 from common import add_polygon_to_map
 
+# Read files in pieces this big, so memory use doesn't grow with file size.
+CHUNK_SIZE = 65536
+
+# How many bytes preceding the checkpoint must match before resuming a parse.
+SIGNATURE_SIZE = 64
+
+
+@contextmanager
+def open_stream(filename):
+    """Open a file for reading, decompressing it transparently if need be.
+    
+    The compression format is identified by it's magic bytes rather than by
+    the filename, and the decompressed data is read incrementally, so memory
+    use stays constant regardless of file size.
+    """
+    archive = None
+    with open(filename, 'rb') as raw:
+        magic = raw.read(6)
+    if magic.startswith('\x1f\x8b'):
+        stream = GzipFile(filename, 'rb')
+    elif magic.startswith('BZh'):
+        stream = BZ2File(filename)
+    elif magic.startswith('\xfd7zXZ\x00'):
+        if LZMAFile is None:
+            raise IOError
+        stream = LZMAFile(filename)
+    elif magic.startswith('PK\x03\x04'):
+        try:
+            archive = ZipFile(filename)
+            names = archive.namelist()
+            kml = [name for name in names if name.lower().endswith('.kml')]
+            stream = archive.open('doc.kml' if 'doc.kml' in names else kml[0])
+        except (BadZipfile, IndexError):
+            raise IOError
+    else:
+        stream = open(filename, 'rb')
+    try:
+        yield stream
+    finally:
+        stream.close()
+        if archive is not None:
+            archive.close()
+
+def unchanged(filename, offset, signature):
+    """Check that the bytes leading up to offset still match the signature."""
+    if offset == 0:
+        return False
+    try:
+        with open_stream(filename) as stream:
+            skip(stream, offset - len(signature))
+            return stream.read(len(signature)) == signature
+    except IOError:
+        return False
+
+def skip(stream, offset):
+    """Advance the stream to offset, even if it can't seek."""
+    try:
+        stream.seek(offset)
+    except (AttributeError, IOError):
+        while offset > 0:
+            data = stream.read(min(offset, CHUNK_SIZE))
+            if not data:
+                break
+            offset -= len(data)
 
 class XMLSimpleParser:
-    """A simple wrapper for the Expat XML parser."""
+    """A simple wrapper for the Expat XML parser.
+    
+    The parser remembers the byte offset just past the last element that it
+    finished tracking, along with the stack of elements that were still open
+    at that point. This allows a file that has had more data appended onto it
+    (eg, a GPS logger that is still writing) to be resumed from that offset
+    without re-reading everything that came before it.
+    """
     
     def __init__(self, rootname, watchlist):
         self.rootname = rootname
@@ -39,36 +131,109 @@ class XMLSimpleParser:
         self.element = None
         self.tracking = None
         self.state = {}
+        self.stack = []
+        self.encoding = 'utf-8'
+        
+        # Where to resume parsing from, if the file grows later.
+        self.checkpoint = []
+        self.signature = ''
+        self.offset = 0
+        self.opened = 0
+        self.base = 0
         
+        self.parser = None
+    
+    def create_parser(self, start_handler):
+        """Create a fresh Expat parser with our handlers attached."""
         self.parser = ParserCreate()
-        self.parser.StartElementHandler = self.element_root
+        self.parser.XmlDeclHandler = self.declaration
+        self.parser.StartElementHandler = start_handler
+        self.parser.EndElementHandler = self.element_end
     
     def parse(self, filename, call_start, call_end):
         """Begin the loading and parsing of the XML file."""
         self.call_start = call_start
         self.call_end = call_end
+        self.create_parser(self.element_root)
+        self.feed(filename, 0)
+        if self.parser.StartElementHandler == self.element_root:
+            raise IOError
+    
+    def feed(self, filename, offset):
+        """Feed the file to Expat one chunk at a time, starting at offset.
+        
+        The parser is never finalized, so that a partially written document
+        yields all of it's complete elements instead of an error.
+        """
+        end, recent = offset, ''
         try:
-            with open(filename) as xml:
-                self.parser.ParseFile(xml)
+            with open_stream(filename) as xml:
+                skip(xml, offset)
+                for chunk in iter(lambda: xml.read(CHUNK_SIZE), ''):
+                    self.parser.Parse(chunk, False)
+                    
+                    # Keep hold of the bytes leading up to the checkpoint,
+                    # rather than seeking back for them afterwards, which
+                    # is expensive in a compressed stream.
+                    end += len(chunk)
+                    recent = recent[-SIGNATURE_SIZE:] + chunk
+                    if self.offset > end - len(chunk):
+                        first = end - len(recent)
+                        self.signature = recent[
+                            max(self.offset - SIGNATURE_SIZE - first, 0):
+                            self.offset - first]
         except ExpatError:
             raise IOError
-   
+    
+    def appended(self, filename):
+        """Check that the file has only grown since it was last parsed."""
+        return unchanged(filename, self.offset, self.signature)
+    
+    def resume(self, filename):
+        """Parse only the data following the last complete element.
+        
+        A new Expat parser is primed with the XML declaration and the opening
+        tags of every element that was open at the checkpoint, which puts it
+        into the same state the old parser was in when it got there.
+        """
+        prefix = '<?xml version="1.0" encoding="%s"?>%s' % (self.encoding,
+            ''.join(['<%s%s>' % (name, ''.join([' %s=%s' % (key,
+            quoteattr(value)) for key, value in attributes.items()]))
+            for name, attributes in self.checkpoint]))
+        prefix = prefix.encode(self.encoding)
+        
+        self.stack = []
+        self.state.clear()
+        self.tracking = None
+        self.create_parser(
+            lambda name, attributes: self.stack.append((name, attributes)))
+        self.base = self.offset - len(prefix)
+        self.parser.Parse(prefix, False)
+        self.parser.StartElementHandler = self.element_start
+        self.feed(filename, self.offset)
+    
+    def declaration(self, version, encoding, standalone):
+        """Remember the document encoding, so that we can resume it later."""
+        self.encoding = encoding or self.encoding
+    
     def element_root(self, name, attributes):
         """Called on the root XML element, we check if it's the one we want."""
         if self.rootname != None and name != self.rootname:
             raise IOError
+        self.stack.append((name, attributes))
         self.parser.StartElementHandler = self.element_start
     
     def element_start(self, name, attributes):
         """Only collect the attributes from XML elements that we care about."""
+        self.stack.append((name, attributes))
         if not self.tracking:
             if name not in self.watchlist:
                 return
             if self.call_start(name, attributes):
                 # Start tracking this element, accumulate everything under it.
                 self.tracking = name
+                self.opened = self.parser.CurrentByteIndex
                 self.parser.CharacterDataHandler = self.element_data
-                self.parser.EndElementHandler = self.element_end
         
         if self.tracking is not None:
             self.element = name
@@ -86,6 +251,7 @@ class XMLSimpleParser:
     
     def element_end(self, name):
         """When the tag closes, pass it's data to the end callback and reset."""
+        self.stack.pop()
         if name != self.tracking:
             return
         
@@ -93,29 +259,165 @@ class XMLSimpleParser:
         self.tracking = None
         self.state.clear()
         self.parser.CharacterDataHandler = None
-        self.parser.EndElementHandler = None
+        
+        # Empty elements like <trkpt/> report their end where they started.
+        index = self.parser.CurrentByteIndex
+        if index != self.opened:
+            index += len(('</%s>' % name).encode(self.encoding))
+        self.offset = self.base + index
+        self.checkpoint = list(self.stack)
+
+
+class NMEAParser:
+    """Read NMEA 0183 sentences from a log.
+    
+    This offers the same interface as XMLSimpleParser so that TrackFile can
+    use either one, but only call_end is ever called, with the sentence type
+    (minus the talker ID) and a list of the sentence's fields. Sentences with
+    bad checksums are discarded, as are partially written lines.
+    """
+    
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.call_end = None
+        self.signature = ''
+        self.offset = 0
+    
+    def parse(self, filename, call_start, call_end):
+        """Read the whole log, raising IOError if it isn't NMEA at all."""
+        self.call_end = call_end
+        if not self.feed(filename, 0):
+            raise IOError
+    
+    def feed(self, filename, offset):
+        """Read complete sentences starting at offset.
+        
+        The log is read in large chunks and split into lines, which is much
+        quicker than reading lines one at a time, particularly when the log
+        is compressed. Only the sentences we care about have their checksums
+        verified. Gives up early if the first chunk doesn't contain any such
+        sentences, so that other kinds of files can be rejected without being
+        read in their entirety. Returns the number of valid sentences found.
+        """
+        valid, tail = 0, ''
+        sentences, call_end = self.sentences, self.call_end
+        with open_stream(filename) as nmea:
+            skip(nmea, offset)
+            for chunk in iter(lambda: nmea.read(CHUNK_SIZE), ''):
+                chunk = tail + chunk
+                complete = chunk.rfind('\n') + 1
+                tail = chunk[complete:]
+                offset += complete
+                self.signature = (self.signature +
+                    chunk[max(complete - SIGNATURE_SIZE, 0):complete]
+                )[-SIGNATURE_SIZE:]
+                
+                for line in chunk[:complete].split('\n'):
+                    start = line.find('$')
+                    if line[start + 3:start + 6] not in sentences:
+                        continue
+                    star = line.rfind('*')
+                    body = line[start + 1:star]
+                    try:
+                        if star < start or reduce(xor, bytearray(body), 0) \
+                                != int(line[star + 1:star + 3], 16):
+                            continue
+                    except ValueError:
+                        continue
+                    valid += 1
+                    fields = body.split(',')
+                    call_end(fields[0][2:], fields)
+                
+                if not valid:
+                    break
+                if len(tail) > CHUNK_SIZE:
+                    # No sentence is that long, so skip over the garbage.
+                    offset += len(tail)
+                    tail = ''
+        
+        self.offset = offset
+        return valid
+    
+    def appended(self, filename):
+        """Check that the file has only grown since it was last parsed."""
+        return unchanged(filename, self.offset, self.signature)
+    
+    def resume(self, filename):
+        """Read only the lines following the last complete line."""
+        self.feed(filename, self.offset)
+
+
+class FITParser:
+    """Decode a FIT file all at once.
+    
+    This offers the same interface as XMLSimpleParser, but FIT files are
+    compact enough to be decoded in one go, so call_end is called only once,
+    with parallel arrays holding every track point.
+    """
+    
+    def parse(self, filename, call_start, call_end):
+        """Decode the file, raising IOError if it has no track points."""
+        with open_stream(filename) as fit:
+            arrays = decode_fit(fit.read())
+        if not arrays[0]:
+            raise IOError
+        call_end('record', arrays)
+    
+    def appended(self, filename):
+        """FIT files aren't written incrementally, so they are never resumed."""
+        return False
 
 
 class TrackFile(Coordinates):
     """Parent class for all types of GPS track files.
     
     Subclasses must implement element_start and element_end, and call them in
-    the base class.
+    the base class. The parser is expected to call these as it encounters the
+    data, and it must also be able to resume where it left off when the
+    file grows.
     """
     
-    def __init__(self, filename, root, watch, progressbar):
+    def __init__(self, filename, parser, progressbar):
+        self.filename = filename
         self.progress = progressbar
         self.clock    = clock()
         self.append   = None
         self.tracks   = {}
         
-        self.parser = XMLSimpleParser(root, watch)
+        self.parser = parser
         self.parser.parse(filename, self.element_start, self.element_end)
         
+        # Eg, NMEA logs recorded before the receiver got a fix.
+        if not self.tracks:
+            raise IOError
+        
         keys = self.tracks.keys()
         self.alpha = min(keys)
         self.omega = max(keys)
     
+    def update(self):
+        """Load only the points that were appended since the last parse.
+        
+        The most recent polygon continues to be extended, and new segments
+        get new polygons as usual. Returns a dict of the new points, or None
+        if the file was modified in some way other than being appended to.
+        """
+        if not self.parser.appended(self.filename):
+            return None
+        
+        self.clock = clock()
+        tracks, self.tracks = self.tracks, {}
+        try:
+            self.parser.resume(self.filename)
+        finally:
+            tracks, self.tracks = self.tracks, tracks
+            self.tracks.update(tracks)
+        
+        if tracks:
+            self.alpha = min(self.alpha, min(tracks))
+            self.omega = max(self.omega, max(tracks))
+        return tracks
+    
     def element_start(self, name, attributes):
         """Placeholder for a method that gets overridden in subclasses."""
         return False
@@ -138,8 +440,8 @@ class GPXFile(TrackFile):
     """Parse a GPX file."""
     
     def __init__(self, filename, progress):
-        TrackFile.__init__(self, filename, 'gpx',
-                           ['trkseg', 'trkpt'], progress)
+        TrackFile.__init__(self, filename,
+            XMLSimpleParser('gpx', ['trkseg', 'trkpt']), progress)
     
     def element_start(self, name, attributes):
         """Adds a new polygon for each new segment, and watches for track points."""
@@ -182,8 +484,8 @@ class KMLFile(TrackFile):
         self.whens    = []
         self.coords   = []
         
-        TrackFile.__init__(self, filename, 'kml', ['gx:Track',
-                           'when', 'gx:coord'], progress)
+        TrackFile.__init__(self, filename, XMLSimpleParser('kml',
+            ['gx:Track', 'when', 'gx:coord']), progress)
     
     def element_start(self, name, attributes):
         """Adds a new polygon for each new gx:Track, and watches for location data."""
@@ -219,3 +521,83 @@ class KMLFile(TrackFile):
         
         TrackFile.element_end(self, name, state)
 
+
+def nmea_to_decimal(value, hemisphere):
+    """Convert NMEA's (d)ddmm.mmmm notation into decimal degrees."""
+    split = value.find('.')
+    if split < 0:
+        split = len(value)
+    return dms_to_decimal(value[:split - 2], value[split - 2:], 0,
+                          hemisphere or ' ')
+
+
+class NMEAFile(TrackFile):
+    """Parse a log of NMEA 0183 sentences.
+    
+    Positions and dates are taken from RMC sentences, and elevations from
+    GGA sentences, so that logs which only contain GGA can't be used because
+    they have no way of telling what day it is.
+    """
+    
+    def __init__(self, filename, progress):
+        self.days      = {}
+        self.elevation = 0.0
+        self.latest    = float('-inf')
+        
+        TrackFile.__init__(self, filename,
+            NMEAParser(['RMC', 'GGA']), progress)
+    
+    def element_end(self, name, fields):
+        """Turn each valid RMC sentence into a track point.
+        
+        Duplicate and out-of-order fixes are ignored, which also means that
+        the final line of a log being resumed can safely be read twice.
+        """
+        if name == 'GGA':
+            try:
+                self.elevation = float(fields[9])
+            except (ValueError, IndexError):
+                pass
+            return
+        
+        # RMC status 'A' means active, 'V' means void (no fix).
+        if len(fields) < 10 or fields[2] != 'A':
+            return
+        try:
+            time, date = fields[1], fields[9]
+            day = self.days.get(date)
+            if day is None:
+                year = int(date[4:6])
+                day = self.days[date] = timegm((
+                    year + (1900 if year >= 80 else 2000),
+                    int(date[2:4]), int(date[0:2]), 0, 0, 0))
+            timestamp = (day + int(time[0:2]) * 3600 +
+                               int(time[2:4]) * 60 + int(time[4:6]))
+            lat = nmea_to_decimal(fields[3], fields[4])
+            lon = nmea_to_decimal(fields[5], fields[6])
+        except (ValueError, IndexError):
+            return
+        
+        if timestamp <= self.latest:
+            return
+        self.latest = timestamp
+        
+        if self.append is None:
+            self.append = add_polygon_to_map()
+        self.tracks[timestamp] = self.append(lat, lon, self.elevation)
+        
+        TrackFile.element_end(self, name, fields)
+
+
+class FITFile(TrackFile):
+    """Parse a Garmin FIT activity file."""
+    
+    def __init__(self, filename, progress):
+        TrackFile.__init__(self, filename, FITParser(), progress)
+    
+    def element_end(self, name, arrays):
+        """Draw the decoded arrays of track points onto the map."""
+        self.append = add_polygon_to_map()
+        for timestamp, lat, lon, ele in izip(*arrays):
+            self.tracks[timestamp] = self.append(lat, lon, ele)
+            TrackFile.element_end(self, name, None)